@@ -1,91 +1,124 @@
-from flask import Flask, request, send_file
+from flask import Flask, Response, request, send_file
 from flask_cors import CORS
-import yt_dlp
-import ffmpeg
 import os
-import uuid
-import requests
-from urllib.parse import urlparse
-from playwright.sync_api import sync_playwright
-from yt_dlp import YoutubeDL
-from playwright.sync_api import sync_playwright, TimeoutError as PlaywrightTimeoutError
+import time
+from concurrent.futures.process import BrokenProcessPool
+
+import metrics
+from cache import ResultCache, cache_key
+from jobs import JobQueue, QueueFull, DONE, ENCODING, FAILED
+from pipeline import (
+    init_worker, process_job, worker_state, INFO_CACHE_DIR, OUTPUT_DIR, TARGET_SIZE_BYTES,
+)
+from storage import StorageManager
 
 # Initialize Flask
 app = Flask(__name__)
-CORS(app, resources={ r"/compress": {"origins": "*"} })
+CORS(app, resources={
+    r"/compress": {"origins": "*"},
+    r"/jobs/*": {"origins": "*"},
+})
 
-# Directory to store videos
-OUTPUT_DIR = "compressed_videos"
-os.makedirs(OUTPUT_DIR, exist_ok=True)
+# Background encoders: one worker per core, a couple of waiting jobs each.
+# Job records and the cache index live in this process, so it has to be
+# served by a single (threaded) web worker.
+queue = JobQueue(
+    workers=int(os.environ.get('WORKERS', 0)) or None,
+    max_pending=int(os.environ.get('MAX_PENDING_JOBS', 0)) or None,
+    initializer=init_worker,
+    initargs=worker_state(),
+)
 
-# Target size: 10MB
-TARGET_SIZE_MB = 10
-TARGET_SIZE_BYTES = TARGET_SIZE_MB * 1024 * 1024
+# Tailing pipelined outputs for /jobs/<id>/stream
+STREAM_CHUNK_BYTES = 64 * 1024
+STREAM_POLL_SECONDS = 0.2
+# Give up on a stream whose output hasn't grown in this long
+STREAM_IDLE_SECONDS = 120
 
-# Domains that need headless browser extraction
-BROWSER_DOMAINS = (
-    'youtube.com', 'youtu.be',
-    'twitter.com', 'x.com'
+# Finished outputs, shared by every request for the same video
+cache = ResultCache(
+    OUTPUT_DIR,
+    max_bytes=int(os.environ.get('CACHE_MAX_BYTES', 2 * 1024 * 1024 * 1024)),
 )
 
+# Clients may keep a result this long; its ETag changes if it is re-encoded
+RESULT_MAX_AGE_SECONDS = 3600
+
+# TTL/quota cleanup of outputs, leftover job files and old job records
+storage = StorageManager(cache, queue, OUTPUT_DIR, INFO_CACHE_DIR)
+storage.start()
+
+metrics.register(metrics.Gauge(
+    'smolfile_pending_jobs', 'Jobs queued or running.', queue.pending))
+metrics.register(metrics.Gauge(
+    'smolfile_workers', 'Size of the encoder pool.', lambda: queue.workers))
+metrics.register(metrics.Gauge(
+    'smolfile_cache_bytes', 'Disk used by cached outputs.', cache.total_bytes))
 
-def download_video(url, output_path):
+
+class StreamAborted(Exception):
     """
-    Download the video at `url` directly via yt-dlp into output_path.
+    Raised inside a /stream response to drop the connection mid-body.
     """
-    print(f"[yt-dlp] downloading {url} to {output_path}")
-    ydl_opts = {
-        "format": "best[ext=mp4]",
-        "outtmpl": output_path,
-        "quiet": True,
-        "nocheckcertificate": True,
-        "geo_bypass": True,
-        "restrictfilenames": True,
-        "noplaylist": True,
-    }
-    with YoutubeDL(ydl_opts) as ydl:
-        ydl.download([url])
-    print(f"[yt-dlp] saved to {output_path}")
-
-    # 2) Fallback: yt-dlp
-    print(f"[yt-dlp] downloading via yt-dlp for {url}")
-    ydl_opts = {
-        "format": "best[ext=mp4]",
-        "outtmpl": output_path,
-        "quiet": True,
-        "nocheckcertificate": True,
-        "geo_bypass": True,
-        "restrictfilenames": True,
-        "noplaylist": True,
-    }
-    with YoutubeDL(ydl_opts) as ydl:
-        ydl.download([url])
-    print(f"[yt-dlp] saved to {output_path}")
 
 
-def compress_video(input_path, output_path):
+def on_body_close(response, callback):
+    """
+    Run `callback` once the server closes `response`'s body.
+
+    send_file responses are direct passthrough: the server closes the file
+    wrapper itself and never calls Response.close(), so call_on_close()
+    would never fire. Hook the wrapper's close() rather than wrapping it,
+    which would stop the server recognising it for sendfile.
     """
-    Compress input_path to output_path targeting under 10MB.
+    body = response.response
+    close = getattr(body, 'close', None)
+
+    def closed():
+        try:
+            if close is not None:
+                close()
+        finally:
+            callback()
+
+    body.close = closed
+
+
+def job_finished(key, job):
+    cache.finish(key, job['id'], job['state'] == DONE)
+    metrics.observe_job(job)
+
+
+def submit_url(url):
     """
-    print(f"[compress_video] probing {input_path}")
-    probe = ffmpeg.probe(input_path)
-    duration = float(probe['format']['duration'])
-    bitrate = (TARGET_SIZE_BYTES * 8) / duration
-    bitrate_k = int(bitrate / 1000)
-    print(f"[compress_video] target bitrate: {bitrate_k}k")
-    (
-        ffmpeg
-        .input(input_path)
-        .output(
-            output_path,
-            video_bitrate=f'{bitrate_k}k',
-            format='mp4',
-            vcodec='libx264',
-            acodec='aac'
+    Return a job id for `url`: a finished one on a cache hit, the job
+    already producing it if there is one, otherwise a freshly queued job.
+    """
+    key = cache_key(url, TARGET_SIZE_BYTES)
+    domain = metrics.domain_label(url)
+    with cache.lock:
+        path = cache.lookup(key)
+        if path:
+            print(f"[cache] hit {key} for {url}")
+            metrics.jobs_total.inc(outcome='cached', strategy='none')
+            return queue.complete(path, domain=domain)
+
+        # A DONE job stays in inflight until its on_done callback has
+        # cached the output; it already has the result, so join it too
+        job_id = cache.inflight.get(key)
+        job = queue.get(job_id) if job_id else None
+        if job is not None and job['state'] != FAILED:
+            print(f"[cache] joining {job_id} for {url}")
+            return job_id
+
+        job_id = queue.submit(
+            process_job, url, cache.path_for(key),
+            on_done=lambda job: job_finished(key, job),
+            domain=domain,
         )
-        .run(overwrite_output=True)
-    )
-    print(f"[compress_video] output saved to {output_path}")
+        cache.inflight[key] = job_id
+        return job_id
+
 
 @app.route('/compress', methods=['POST'])
 def compress():
@@ -93,34 +126,121 @@ def compress():
     if not url:
         return {'error': 'No URL provided'}, 400
 
-    uid = str(uuid.uuid4())
-    raw = os.path.join(OUTPUT_DIR, f"{uid}_raw.mp4")
-    small = os.path.join(OUTPUT_DIR, f"{uid}_smol.mp4")
+    try:
+        job_id = submit_url(url)
+    except QueueFull:
+        return {'error': 'Server is busy, try again shortly.'}, 429
+    except BrokenProcessPool:
+        # Even a freshly started pool failed; nothing was queued
+        return {'error': 'Compression workers are unavailable, try again shortly.'}, 503
+
+    return {'id': job_id, 'state': queue.get(job_id)['state']}, 202
+
 
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = queue.get(job_id)
+    if job is None:
+        return {'error': 'Unknown job'}, 404
+    return {
+        'id': job['id'],
+        'state': job['state'],
+        'progress': job['progress'],
+        'error': job['error'],
+        'stages': job['stages'],
+    }
+
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    job = queue.get(job_id)
+    if job is None:
+        return {'error': 'Unknown job'}, 404
+    if job['state'] != DONE:
+        return {'error': f"Job is {job['state']}"}, 409
+    started = time.monotonic()
+    path = os.path.abspath(job['result'])
     try:
-        download_video(url, raw)
-    except ValueError as ve:
-        return {'error': str(ve)}, 400
+        # A re-encode after eviction writes different bytes under the same
+        # cache key, so the ETag has to change with the file itself
+        st = os.stat(path)
+        etag = f"{os.path.splitext(os.path.basename(path))[0]}-{st.st_size}-{st.st_mtime_ns}"
+        # conditional=True answers Range, If-Range and If-None-Match
+        response = send_file(
+            path,
+            mimetype='video/mp4',
+            as_attachment=True,
+            download_name=f"{job_id}_smol.mp4",
+            conditional=True,
+            etag=etag,
+            max_age=RESULT_MAX_AGE_SECONDS,
+        )
+    except FileNotFoundError:
+        # Evicted from the cache since the job finished
+        return {'error': 'Result expired, submit the URL again.'}, 410
+    on_body_close(response, lambda: metrics.stage_seconds.observe(
+        time.monotonic() - started, stage='send', domain=job['domain'] or 'unknown'))
+    return response
 
+
+@app.route('/jobs/<job_id>/stream', methods=['GET'])
+def job_stream(job_id):
+    """
+    Send a pipelined job's fragmented MP4 while it is still being encoded.
+    """
+    job = queue.get(job_id)
+    if job is None:
+        return {'error': 'Unknown job'}, 404
+    if job['state'] == DONE:
+        return job_result(job_id)
+    if job['state'] == FAILED or not job['partial']:
+        return {'error': f"Job is {job['state']} and not streamable"}, 409
+
+    partial = job['partial']
     try:
-        compress_video(raw, small)
-    except FileNotFoundError as fnf:
-        # Likely ffprobe is missing
-        return {
-            'error': 'Server misconfiguration: ffmpeg/ffprobe not found on the host.'
-        }, 500
-    except Exception as e:
-        # print the real stack to the logs
-        import traceback
-        traceback.print_exc()
-        return {'error': 'Compression failed due to an internal error.'}, 500
-    finally:
-        # clean up raw file if it exists
-        if os.path.exists(raw):
-            os.remove(raw)
-
-    return send_file(small, as_attachment=True)
+        f = open(partial, 'rb')
+    except FileNotFoundError:
+        # Either ffmpeg hasn't created it yet or it was just moved into
+        # the cache
+        if queue.get(job_id)['state'] == DONE:
+            return job_result(job_id)
+        return {'error': 'Output not started yet, try again shortly.'}, 409
+
+    def generate():
+        # The file is renamed into the cache when the job finishes; the open
+        # handle keeps reading it regardless
+        last_data = time.monotonic()
+        with f:
+            while True:
+                chunk = f.read(STREAM_CHUNK_BYTES)
+                if chunk:
+                    last_data = time.monotonic()
+                    yield chunk
+                    continue
+                current = queue.get(job_id)
+                if current is not None and current['partial'] == partial:
+                    if current['state'] == DONE:
+                        chunk = f.read()
+                        if chunk:
+                            yield chunk
+                        return
+                    if (current['state'] == ENCODING
+                            and time.monotonic() - last_data < STREAM_IDLE_SECONDS):
+                        time.sleep(STREAM_POLL_SECONDS)
+                        continue
+                # Failed, stalled, or the job threw this output away and
+                # started over; cut the connection rather than end it
+                # cleanly so the client doesn't keep a partial file
+                raise StreamAborted(f"stream of {job_id} abandoned")
+
+    return Response(generate(), mimetype='video/mp4')
+
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
-    app.run(host='0.0.0.0', port=port)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=port)
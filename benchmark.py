@@ -0,0 +1,362 @@
+"""
+Offline benchmark for the compress pipeline.
+
+Generates a corpus of synthetic videos with ffmpeg's lavfi sources, serves
+them from a local HTTP server (so yt-dlp's generic extractor can fetch
+them without network access), starts the app, and drives /compress at a
+fixed concurrency. Results are written as JSON so runs can be compared:
+
+    python benchmark.py --concurrency 4 --output results.json
+    python benchmark.py --durations 10 60 --compare results.json
+"""
+import argparse
+import json
+import mimetypes
+import os
+import re
+import signal
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import ffmpeg
+import requests
+
+from pipeline import TARGET_SIZE_BYTES
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# codec name -> (video codec, audio codec, container, extra output options)
+CODECS = {
+    'h264': ('libx264', 'aac', 'mp4', {'preset': 'veryfast'}),
+    'hevc': ('libx265', 'aac', 'mp4', {'preset': 'veryfast', 'tag:v': 'hvc1'}),
+    'vp9': ('libvpx-vp9', 'libopus', 'webm', {'deadline': 'realtime', 'cpu-used': 8}),
+}
+# Source bitrates high enough that most clips need real compression
+SOURCE_BITRATE_K = {360: 1500, 720: 5000, 1080: 10000}
+
+POLL_SECONDS = 0.25
+READY_TIMEOUT_SECONDS = 30
+
+
+def generate_corpus(directory, durations, heights, codecs):
+    """
+    Render every duration x height x codec combination into `directory`,
+    skipping files that already exist. Returns a list of corpus entries.
+    """
+    os.makedirs(directory, exist_ok=True)
+    corpus = []
+    for codec in codecs:
+        vcodec, acodec, ext, extra = CODECS[codec]
+        for height in heights:
+            width = height * 16 // 9
+            for duration in durations:
+                name = f"{codec}_{height}p_{duration}s.{ext}"
+                path = os.path.join(directory, name)
+                if not os.path.exists(path):
+                    print(f"[bench] generating {name}")
+                    video = ffmpeg.input(f"testsrc2=size={width}x{height}:rate=30:duration={duration}",
+                                         format='lavfi')
+                    audio = ffmpeg.input(f"sine=frequency=440:sample_rate=48000:duration={duration}",
+                                         format='lavfi')
+                    (
+                        ffmpeg
+                        .output(video, audio, path, vcodec=vcodec, acodec=acodec,
+                                video_bitrate=f"{SOURCE_BITRATE_K.get(height, 5000)}k",
+                                pix_fmt='yuv420p', **extra)
+                        .run(overwrite_output=True, quiet=True)
+                    )
+                corpus.append({
+                    'file': name,
+                    'codec': codec,
+                    'height': height,
+                    'duration': duration,
+                    'bytes': os.path.getsize(path),
+                })
+    return corpus
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """
+    Static file handler with single-range support, which both yt-dlp and
+    the parallel downloader rely on.
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def send_head(self):
+        path = self.translate_path(self.path.split('?', 1)[0])
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return None
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        match = re.match(r'bytes=(\d*)-(\d*)$', self.headers.get('Range', ''))
+        if match and (match[1] or match[2]):
+            if match[1]:
+                start = int(match[1])
+                end = min(int(match[2]), size - 1) if match[2] else size - 1
+            else:
+                start = max(size - int(match[2]), 0)
+            if start > end:
+                self.send_error(416)
+                return None
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', mimetypes.guess_type(path)[0] or 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        f = open(path, 'rb')
+        f.seek(start)
+        self._remaining = end - start + 1
+        return f
+
+    def copyfile(self, source, outputfile):
+        while self._remaining > 0:
+            chunk = source.read(min(64 * 1024, self._remaining))
+            if not chunk:
+                break
+            outputfile.write(chunk)
+            self._remaining -= len(chunk)
+
+
+def serve_corpus(directory):
+    """
+    Serve `directory` on a free localhost port in a background thread.
+    """
+    def handler(*args, **kwargs):
+        return RangeRequestHandler(*args, directory=directory, **kwargs)
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def start_app(port, env_overrides):
+    env = dict(os.environ, PORT=str(port), **env_overrides)
+    proc = subprocess.Popen([sys.executable, 'app.py'], cwd=HERE, env=env,
+                            start_new_session=True)
+    base = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + READY_TIMEOUT_SECONDS
+    while time.monotonic() < deadline:
+        try:
+            requests.get(f"{base}/metrics", timeout=1)
+            return proc, base
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    stop_app(proc)
+    raise RuntimeError("app did not start")
+
+
+def stop_app(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        return
+    try:
+        proc.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        os.killpg(proc.pid, signal.SIGKILL)
+
+
+def _proc_stat(pid):
+    with open(f"/proc/{pid}/stat") as f:
+        # Fields after the parenthesised command name, which may contain spaces
+        return f.read().rsplit(')', 1)[1].split()
+
+
+def tree_cpu_seconds(root_pid):
+    """
+    CPU seconds used by `root_pid` and its live descendants, including the
+    children they have already reaped (ffmpeg runs end up there).
+    """
+    children = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                children.setdefault(int(_proc_stat(entry)[1]), []).append(int(entry))
+            except (OSError, IndexError):
+                continue
+    ticks = os.sysconf('SC_CLK_TCK')
+    total, stack = 0, [root_pid]
+    while stack:
+        pid = stack.pop()
+        try:
+            fields = _proc_stat(pid)
+        except OSError:
+            continue
+        # utime, stime, cutime, cstime
+        total += sum(int(v) for v in fields[11:15])
+        stack.extend(children.get(pid, []))
+    return total / ticks
+
+
+def run_job(base, media_url, entry):
+    """
+    Submit one URL, wait for it and fetch the result. Returns a job record.
+    """
+    record = dict(entry, url=media_url, rejected=0)
+    started = time.monotonic()
+    while True:
+        resp = requests.post(f"{base}/compress", data={'url': media_url}, timeout=30)
+        if resp.status_code != 429:
+            break
+        record['rejected'] += 1
+        time.sleep(1)
+    if resp.status_code != 202:
+        record.update(state='error', error=resp.text)
+        return record
+
+    job_id = resp.json()['id']
+    while True:
+        status = requests.get(f"{base}/jobs/{job_id}", timeout=30).json()
+        if status['state'] in ('done', 'failed'):
+            break
+        time.sleep(POLL_SECONDS)
+    record.update(id=job_id, state=status['state'], error=status['error'],
+                  stages=status.get('stages') or {})
+
+    if status['state'] == 'done':
+        fetch_started = time.monotonic()
+        result = requests.get(f"{base}/jobs/{job_id}/result", timeout=300)
+        record['stages']['fetch'] = time.monotonic() - fetch_started
+        record['output_bytes'] = len(result.content)
+        record['over_target'] = len(result.content) > TARGET_SIZE_BYTES
+    record['stages']['total'] = time.monotonic() - started
+    return record
+
+
+def percentile(values, pct):
+    """
+    Nearest-rank percentile of `values`.
+    """
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    rank = max(int(round(pct / 100 * len(ordered))) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def summarize(records, wall_seconds, cpu_seconds):
+    done = [r for r in records if r['state'] == 'done']
+    stage_names = sorted({name for r in records for name in r.get('stages', {})})
+    stages = {}
+    for name in stage_names:
+        values = [r['stages'][name] for r in done if name in r.get('stages', {})]
+        stages[name] = {'p50': percentile(values, 50), 'p95': percentile(values, 95),
+                        'count': len(values)}
+
+    output_mb = sum(r['output_bytes'] for r in done) / (1024 * 1024)
+    return {
+        'jobs': len(records),
+        'done': len(done),
+        'failed': len(records) - len(done),
+        'rejected_429': sum(r['rejected'] for r in records),
+        'wall_seconds': wall_seconds,
+        'jobs_per_minute': len(done) / wall_seconds * 60 if wall_seconds else None,
+        'stages': stages,
+        'cpu_seconds': cpu_seconds,
+        'cpu_seconds_per_output_mb': cpu_seconds / output_mb if cpu_seconds and output_mb else None,
+        'pct_over_target': (100 * sum(r['over_target'] for r in done) / len(done)) if done else None,
+    }
+
+
+def compare(summary, previous):
+    """
+    Print headline numbers next to those from an earlier results file.
+    """
+    old = previous['summary']
+    for key in ('jobs_per_minute', 'cpu_seconds_per_output_mb', 'pct_over_target'):
+        print(f"{key:28} {old.get(key)!s:>12} -> {summary.get(key)!s:>12}")
+    for name, now in summary['stages'].items():
+        before = old.get('stages', {}).get(name, {})
+        print(f"{name + ' p50/p95':28} {before.get('p50')!s:>12} -> {now['p50']!s:>12}"
+              f"  /  {before.get('p95')!s} -> {now['p95']!s}")
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=HERE,
+                                       text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--corpus-dir', default=os.path.join(HERE, 'bench_corpus'))
+    parser.add_argument('--durations', type=int, nargs='+', default=[10, 60, 180])
+    parser.add_argument('--heights', type=int, nargs='+', default=[360, 720, 1080])
+    parser.add_argument('--codecs', nargs='+', default=['h264', 'hevc'], choices=sorted(CODECS),
+                        help='vp9 sources are WebM, which the app currently rejects')
+    parser.add_argument('--concurrency', type=int, default=2)
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='submit each corpus file this many times')
+    parser.add_argument('--server', help='use an already running app at this URL '
+                                         '(CPU usage is then not measured)')
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--env', nargs='*', default=[], metavar='KEY=VALUE',
+                        help='extra environment for the app, e.g. PIPELINE=1')
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--compare', help='earlier results file to compare against')
+    args = parser.parse_args()
+
+    corpus = generate_corpus(args.corpus_dir, args.durations, args.heights, args.codecs)
+    media_server, media_base = serve_corpus(args.corpus_dir)
+
+    proc = None
+    if args.server:
+        base = args.server.rstrip('/')
+    else:
+        proc, base = start_app(args.port, dict(item.split('=', 1) for item in args.env))
+
+    # A fresh query string per run keeps the result cache from answering
+    run_id = uuid.uuid4().hex[:8]
+    work = [(f"{media_base}/{entry['file']}?run={run_id}-{i}", entry)
+            for i in range(args.repeat) for entry in corpus]
+
+    try:
+        cpu_before = tree_cpu_seconds(proc.pid) if proc else None
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            records = list(pool.map(lambda item: run_job(base, *item), work))
+        wall = time.monotonic() - started
+        cpu = tree_cpu_seconds(proc.pid) - cpu_before if proc else None
+    finally:
+        if proc:
+            stop_app(proc)
+        media_server.shutdown()
+
+    summary = summarize(records, wall, cpu)
+    results = {
+        'meta': {
+            'run_id': run_id,
+            'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'revision': git_revision(),
+            'cpu_count': os.cpu_count(),
+            'target_bytes': TARGET_SIZE_BYTES,
+            'args': vars(args),
+        },
+        'summary': summary,
+        'jobs': records,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    print(json.dumps(summary, indent=2))
+    print(f"[bench] results written to {args.output}")
+    if args.compare:
+        with open(args.compare) as f:
+            compare(summary, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+import multiprocessing
+import multiprocessing.util
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+# Domains that need headless browser extraction
+BROWSER_DOMAINS = (
+    'youtube.com', 'youtu.be',
+    'twitter.com', 'x.com'
+)
+
+# Warm contexts kept per worker, one per site
+BROWSER_CONTEXTS = int(os.environ.get('BROWSER_CONTEXTS', 2))
+# Pages open at once across all workers; each costs a renderer process
+BROWSER_MAX_PAGES = int(os.environ.get('BROWSER_MAX_PAGES', 2))
+# Throw a context away after this many pages so leaks don't pile up
+BROWSER_CONTEXT_MAX_USES = int(os.environ.get('BROWSER_CONTEXT_MAX_USES', 50))
+PAGE_TIMEOUT_MS = 20000
+# How long to wait for a free page slot before giving up on the fallback.
+# Bounded because a worker killed while holding a slot never gives it back.
+PAGE_SLOT_TIMEOUT_SECONDS = int(os.environ.get('PAGE_SLOT_TIMEOUT_SECONDS', 60))
+# Extra time after load for the player to set its cookies
+SETTLE_MS = 1500
+
+# Cross-worker page semaphore, handed to each worker by init_worker()
+_page_slots = None
+
+
+def page_slots():
+    """
+    A semaphore for BROWSER_MAX_PAGES pages, to create in the web process
+    and pass to every pool worker's init_worker().
+    """
+    return multiprocessing.BoundedSemaphore(BROWSER_MAX_PAGES)
+
+
+def init_worker(slots):
+    global _page_slots
+    _page_slots = slots
+
+
+def site_for(url):
+    """
+    The BROWSER_DOMAINS entry `url` belongs to, or None.
+    """
+    host = (urlparse(url).hostname or '').lower()
+    for domain in BROWSER_DOMAINS:
+        if host == domain or host.endswith('.' + domain):
+            return domain
+    return None
+
+
+def needs_browser(url):
+    return site_for(url) is not None
+
+
+class BrowserPool:
+    """
+    One headless Chromium per worker process, started on first use, with
+    a few persistent contexts reused across jobs.
+
+    Playwright's sync API is tied to the thread that started it; workers
+    run jobs on their main thread, so that is the only caller.
+    """
+
+    def __init__(self, size=BROWSER_CONTEXTS, max_uses=BROWSER_CONTEXT_MAX_USES):
+        self.size = size
+        self.max_uses = max_uses
+        self._playwright = None
+        self._browser = None
+        self._contexts = OrderedDict()
+        self._lock = threading.Lock()
+        self._finalizer = None
+
+    def _start(self):
+        # Only workers that actually hit a browser domain pay for this
+        from playwright.sync_api import sync_playwright
+        print("[browser] launching chromium")
+        self._playwright = sync_playwright().start()
+        self._browser = self._playwright.chromium.launch(
+            headless=True,
+            args=['--disable-dev-shm-usage', '--disable-gpu'],
+        )
+        self._contexts.clear()
+        if self._finalizer is None:
+            # Pool workers exit without running atexit handlers, but they
+            # do run multiprocessing finalizers registered in the worker
+            self._finalizer = multiprocessing.util.Finalize(
+                None, self.close, exitpriority=10)
+
+    def _context(self, site):
+        if self._browser is None or not self._browser.is_connected():
+            self._start()
+
+        entry = self._contexts.pop(site, None)
+        if entry is not None and entry['uses'] >= self.max_uses:
+            print(f"[browser] recycling context for {site} after {entry['uses']} uses")
+            entry['context'].close()
+            entry = None
+        if entry is None:
+            while len(self._contexts) >= self.size:
+                _, oldest = self._contexts.popitem(last=False)
+                oldest['context'].close()
+            entry = {'context': self._browser.new_context(), 'uses': 0}
+        entry['uses'] += 1
+        self._contexts[site] = entry
+        return entry['context']
+
+    @contextmanager
+    def page(self, site):
+        """
+        Open a page in the warm context for `site`; yields (page, context).
+        """
+        if _page_slots is None:
+            # Not running in the job pool; limit this process alone
+            init_worker(page_slots())
+        slots = _page_slots
+        if not slots.acquire(timeout=PAGE_SLOT_TIMEOUT_SECONDS):
+            raise RuntimeError(
+                f"no browser page free after {PAGE_SLOT_TIMEOUT_SECONDS}s")
+        try:
+            with self._lock:
+                context = self._context(site)
+                page = context.new_page()
+                page.set_default_timeout(PAGE_TIMEOUT_MS)
+                try:
+                    yield page, context
+                finally:
+                    page.close()
+        finally:
+            slots.release()
+
+    def close(self):
+        with self._lock:
+            for entry in self._contexts.values():
+                entry['context'].close()
+            self._contexts.clear()
+            if self._browser is not None:
+                self._browser.close()
+                self._playwright.stop()
+            self._browser = self._playwright = None
+
+
+pool = BrowserPool()
+
+
+def _netscape_line(cookie):
+    domain = cookie['domain']
+    expires = int(cookie['expires']) if cookie.get('expires', -1) > 0 else 0
+    return '\t'.join([
+        domain,
+        'TRUE' if domain.startswith('.') else 'FALSE',
+        cookie.get('path') or '/',
+        'TRUE' if cookie.get('secure') else 'FALSE',
+        str(expires),
+        cookie['name'],
+        cookie['value'],
+    ])
+
+
+def refresh_cookies(url, cookie_path):
+    """
+    Load `url` in the site's browser context and save the cookies it ends
+    up with to cookie_path in the Netscape format yt-dlp reads.
+    """
+    from playwright.sync_api import TimeoutError as PlaywrightTimeoutError
+
+    site = site_for(url)
+    print(f"[browser] loading {url} for {site} cookies")
+    with pool.page(site) as (page, context):
+        page.goto(url, wait_until='domcontentloaded')
+        try:
+            page.wait_for_load_state('networkidle')
+        except PlaywrightTimeoutError:
+            # Players keep polling forever on some pages; what we have is enough
+            pass
+        page.wait_for_timeout(SETTLE_MS)
+        cookies = context.cookies()
+
+    os.makedirs(os.path.dirname(cookie_path), exist_ok=True)
+    tmp = f"{cookie_path}.{os.getpid()}.tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write('# Netscape HTTP Cookie File\n')
+        for cookie in cookies:
+            f.write(_netscape_line(cookie) + '\n')
+    os.replace(tmp, cookie_path)
+    print(f"[browser] saved {len(cookies)} cookies to {cookie_path}")
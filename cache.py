@@ -0,0 +1,208 @@
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qsl, urlencode, urlunparse
+
+# Query parameters that only track where a link was shared from, on any site
+TRACKING_PARAMS = ('fbclid', 'gclid', 'igshid')
+
+# Share and timestamp parameters that don't change which video these sites
+# serve; elsewhere they may be part of the address
+SITE_PARAMS = {
+    'youtube.com': ('si', 'feature', 't'),
+    'youtu.be': ('si', 'feature', 't'),
+    'twitter.com': ('s', 't', 'si'),
+}
+
+# Hosts that serve the same content under more than one name
+HOST_ALIASES = {
+    'm.youtube.com': 'youtube.com',
+    'music.youtube.com': 'youtube.com',
+    'mobile.twitter.com': 'twitter.com',
+    'x.com': 'twitter.com',
+    'vxtwitter.com': 'twitter.com',
+    'fxtwitter.com': 'twitter.com',
+}
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+KEY_RE = re.compile(r'^[0-9a-f]{64}$')
+
+
+def normalize_url(url):
+    """
+    Reduce `url` to a canonical form so share-link variants of the same
+    video map to one cache entry.
+    """
+    parts = urlparse(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    host = HOST_ALIASES.get(host, host)
+    site_params = SITE_PARAMS.get(host, ())
+    path = parts.path.rstrip('/') or '/'
+    query = [
+        (k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+        if k not in TRACKING_PARAMS and k not in site_params
+        and not k.startswith('utm_')
+    ]
+
+    # youtu.be/<id> and /shorts/<id> are the same video as /watch?v=<id>
+    if host == 'youtu.be' and path != '/':
+        host, query = 'youtube.com', [('v', path.lstrip('/'))] + query
+        path = '/watch'
+    elif host == 'youtube.com' and path.startswith('/shorts/'):
+        query = [('v', path.split('/')[2])] + query
+        path = '/watch'
+
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    if site_params:
+        # The big sites serve the same video over http and https
+        scheme = 'https'
+    elif port and port != DEFAULT_PORTS.get(scheme):
+        # Different ports can be different servers
+        host = f"{host}:{port}"
+
+    return urlunparse((scheme, host, path, '', urlencode(sorted(query)), ''))
+
+
+def cache_key(url, target_bytes):
+    """
+    Content key for the compressed output of `url` at `target_bytes`.
+    """
+    raw = f"{normalize_url(url)}|{target_bytes}"
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """
+    LRU cache of finished outputs stored as `<key>.mp4` in `directory`,
+    bounded by `max_bytes` of disk.
+
+    `inflight` maps keys to the id of the job currently producing them so
+    repeat submissions can share it; callers hold `lock` while consulting it.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.RLock()
+        self.inflight = {}
+        self._entries = OrderedDict()
+        self._total = 0
+        self._load()
+
+    def path_for(self, key):
+        return os.path.join(self.directory, f"{key}.mp4")
+
+    def lookup(self, key):
+        """
+        Return the cached path for `key` and mark it recently used, or None.
+        """
+        with self.lock:
+            if key not in self._entries:
+                return None
+            path = self.path_for(key)
+            if not os.path.exists(path):
+                self._total -= self._entries.pop(key)
+                return None
+            self._entries.move_to_end(key)
+            # Recency lives in atime; mtime stays the time the file was
+            # written, which result ETags are built from
+            os.utime(path, ns=(time.time_ns(), os.stat(path).st_mtime_ns))
+            return path
+
+    def total_bytes(self):
+        with self.lock:
+            return self._total
+
+    def add(self, key):
+        """
+        Register the file already written at path_for(key) and evict the
+        least recently used entries until the cache fits its budget.
+        """
+        with self.lock:
+            size = os.path.getsize(self.path_for(key))
+            if key in self._entries:
+                self._total -= self._entries.pop(key)
+            self._entries[key] = size
+            self._total += size
+            self._evict(keep=key)
+
+    def finish(self, key, job_id, ok):
+        """
+        Clear the in-flight marker for `key` and cache the output if `ok`.
+        """
+        with self.lock:
+            if self.inflight.get(key) == job_id:
+                del self.inflight[key]
+            if ok:
+                self.add(key)
+
+    def expire(self, max_age):
+        """
+        Drop entries not used in the last `max_age` seconds; returns how many.
+        """
+        cutoff = time.time() - max_age
+        removed = 0
+        with self.lock:
+            # Oldest first, so stop at the first entry that is still fresh
+            while self._entries:
+                key = next(iter(self._entries))
+                try:
+                    if os.path.getatime(self.path_for(key)) >= cutoff:
+                        break
+                except FileNotFoundError:
+                    pass
+                self._remove_oldest()
+                removed += 1
+        return removed
+
+    def shrink(self, nbytes):
+        """
+        Evict least recently used entries until `nbytes` have been freed.
+        """
+        freed = 0
+        with self.lock:
+            while self._entries and freed < nbytes:
+                freed += self._remove_oldest()
+        return freed
+
+    def _evict(self, keep):
+        while self._total > self.max_bytes and len(self._entries) > 1:
+            if next(iter(self._entries)) == keep:
+                break
+            self._remove_oldest()
+
+    def _remove_oldest(self):
+        key, size = self._entries.popitem(last=False)
+        self._total -= size
+        try:
+            os.remove(self.path_for(key))
+        except FileNotFoundError:
+            pass
+        print(f"[cache] evicted {key} ({size} bytes)")
+        return size
+
+    def _load(self):
+        # Rebuild the index from disk, oldest use first (lookup() touches atime)
+        found = []
+        for name in os.listdir(self.directory):
+            stem, ext = os.path.splitext(name)
+            if ext != '.mp4' or not KEY_RE.match(stem):
+                continue
+            st = os.stat(os.path.join(self.directory, name))
+            found.append((st.st_atime, stem, st.st_size))
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+            self._total += size
+        if found:
+            print(f"[cache] loaded {len(found)} entries ({self._total} bytes)")
+            self._evict(keep=None)
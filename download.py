@@ -0,0 +1,239 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+from cache import normalize_url
+
+# How long an extract_info result stays usable; media URLs expire, so
+# keep this well under the few hours most sites sign them for
+INFO_TTL_SECONDS = int(os.environ.get('INFO_TTL_SECONDS', 600))
+
+# Parallel fragments for HLS/DASH sources (handed to yt-dlp)
+FRAGMENT_CONCURRENCY = int(os.environ.get('FRAGMENT_CONCURRENCY', 4))
+
+# Byte ranges fetched in parallel for plain HTTP sources
+RANGE_CHUNK_BYTES = 4 * 1024 * 1024
+READ_CHUNK_BYTES = 256 * 1024
+CONTENT_RANGE_RE = re.compile(r'bytes (\d+)-(\d+)/(\d+)$')
+
+# Open connections per host for the parallel range downloader, e.g.
+# HOST_CONCURRENCY="googlevideo.com=6,twimg.com=2". A configured host (and
+# its subdomains) shares its limit across all workers; any other host gets
+# DEFAULT_HOST_CONCURRENCY connections in each worker process. yt-dlp's own
+# downloads, including HLS/DASH fragments, are bounded by
+# FRAGMENT_CONCURRENCY instead and don't count against these.
+DEFAULT_HOST_CONCURRENCY = int(os.environ.get('DEFAULT_HOST_CONCURRENCY', 4))
+# A worker killed mid-download never returns its shared slot; don't wait
+# on a leaked one forever
+HOST_SLOT_TIMEOUT_SECONDS = 60
+
+
+def _parse_host_limits(spec):
+    limits = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        host, _, limit = item.partition('=')
+        limits[host.strip().lower()] = int(limit)
+    return limits
+
+
+HOST_LIMITS = _parse_host_limits(os.environ.get('HOST_CONCURRENCY', ''))
+
+_session = None
+_session_lock = threading.Lock()
+# Per-process slots for hosts without a configured limit
+_host_slots = {}
+# Cross-worker slots for HOST_LIMITS hosts, handed over by init_worker()
+_shared_slots = {}
+
+
+def shared_host_slots():
+    """
+    One semaphore per HOST_LIMITS entry, to create in the web process and
+    pass to every pool worker's init_worker().
+    """
+    return {host: multiprocessing.BoundedSemaphore(limit)
+            for host, limit in HOST_LIMITS.items()}
+
+
+def init_worker(slots):
+    _shared_slots.clear()
+    _shared_slots.update(slots)
+
+
+def session():
+    """
+    The process-wide pooled HTTP session, created on first use.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            pool = max([DEFAULT_HOST_CONCURRENCY, *HOST_LIMITS.values()])
+            adapter = HTTPAdapter(pool_connections=16, pool_maxsize=pool,
+                                  max_retries=2)
+            _session = requests.Session()
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+        return _session
+
+
+def _host_pattern(host):
+    for pattern in HOST_LIMITS:
+        if host == pattern or host.endswith('.' + pattern):
+            return pattern
+    return None
+
+
+def host_limit(host):
+    """
+    Configured connection limit for `host`, matching parent domains too.
+    """
+    pattern = _host_pattern(host.lower())
+    return HOST_LIMITS[pattern] if pattern else DEFAULT_HOST_CONCURRENCY
+
+
+@contextmanager
+def host_slot(url):
+    """
+    Hold one of the connection slots for `url`'s host.
+    """
+    import requests
+
+    host = (urlparse(url).hostname or '').lower()
+    slot = _shared_slots.get(_host_pattern(host))
+    if slot is None:
+        with _session_lock:
+            slot = _host_slots.get(host)
+            if slot is None:
+                slot = _host_slots[host] = threading.BoundedSemaphore(host_limit(host))
+    if not slot.acquire(timeout=HOST_SLOT_TIMEOUT_SECONDS):
+        raise requests.Timeout(f"no connection slot for {host} "
+                               f"after {HOST_SLOT_TIMEOUT_SECONDS}s")
+    try:
+        yield
+    finally:
+        slot.release()
+
+
+def cached_extract(url, ydl_opts, cache_dir):
+    """
+    yt-dlp extract_info for `url`, reusing a result saved in `cache_dir`
+    within the last INFO_TTL_SECONDS.
+
+    Results go to disk rather than memory so every worker process, and
+    retries after a restart, can share them.
+    """
+    key = hashlib.sha256(normalize_url(url).encode('utf-8')).hexdigest()
+    path = os.path.join(cache_dir, f"{key}.json")
+    try:
+        if time.time() - os.path.getmtime(path) < INFO_TTL_SECONDS:
+            with open(path, encoding='utf-8') as f:
+                print(f"[download] extract cache hit for {url}")
+                return json.load(f)
+    except (OSError, ValueError):
+        pass
+
+    from yt_dlp import YoutubeDL
+
+    print(f"[yt-dlp] extracting {url}")
+    with YoutubeDL(ydl_opts) as ydl:
+        info = ydl.sanitize_info(ydl.extract_info(url, download=False))
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(info, f)
+    os.replace(tmp, path)
+    return info
+
+
+def parallel_download(fmt, output_path, progress_hook=None):
+    """
+    Fetch a plain HTTP(S) yt-dlp format into output_path as parallel byte
+    ranges over the pooled session.
+
+    The total size comes from the server's Content-Range, not the
+    extractor's metadata. Returns False, removing anything written, if the
+    server can't do ranges or disagrees with the metadata, so the caller
+    can fall back to yt-dlp's own downloader.
+    """
+    import requests
+
+    url = fmt['url']
+    headers = dict(fmt.get('http_headers') or {})
+    done = [0]
+    lock = threading.Lock()
+
+    def fetch(fd, start, end):
+        # Returns the file's total size as this response reports it
+        with host_slot(url):
+            resp = session().get(url, headers=dict(headers, Range=f"bytes={start}-{end}"),
+                                 stream=True, timeout=30)
+            with resp:
+                match = CONTENT_RANGE_RE.match(resp.headers.get('Content-Range', ''))
+                if resp.status_code != 206 or not match or int(match[1]) != start:
+                    raise requests.HTTPError(
+                        f"expected 206 for bytes {start}-{end}, got {resp.status_code} "
+                        f"({resp.headers.get('Content-Range')})")
+                # The server clamps the first range to the file
+                end, total = int(match[2]), int(match[3])
+                offset = start
+                for data in resp.iter_content(READ_CHUNK_BYTES):
+                    os.pwrite(fd, data, offset)
+                    offset += len(data)
+                    with lock:
+                        done[0] += len(data)
+                        if progress_hook:
+                            progress_hook({'status': 'downloading',
+                                           'downloaded_bytes': done[0],
+                                           'total_bytes': total})
+        if offset != end + 1:
+            raise requests.HTTPError(f"short range {start}-{end}: got {offset - start} bytes")
+        return total
+
+    fd = os.open(output_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+    pool = None
+    ok = False
+    try:
+        # The first range tells us the real size before fanning out
+        size = fetch(fd, 0, RANGE_CHUNK_BYTES - 1)
+        if fmt.get('filesize') and fmt['filesize'] != size:
+            raise requests.HTTPError(
+                f"server reports {size} bytes, extractor said {fmt['filesize']}")
+
+        ranges = [(start, min(start + RANGE_CHUNK_BYTES, size) - 1)
+                  for start in range(RANGE_CHUNK_BYTES, size, RANGE_CHUNK_BYTES)]
+        workers = max(min(len(ranges), host_limit(urlparse(url).hostname or '')), 1)
+        print(f"[download] {size} bytes from {urlparse(url).hostname} "
+              f"in {len(ranges) + 1} ranges, {workers} at a time")
+
+        os.ftruncate(fd, size)
+        pool = ThreadPoolExecutor(max_workers=workers)
+        for future in [pool.submit(fetch, fd, start, end) for start, end in ranges]:
+            total = future.result()
+            if total != size:
+                raise requests.HTTPError(f"file changed size during download: {total}")
+        ok = True
+    except requests.RequestException as e:
+        print(f"[download] parallel download failed for {url}: {e}")
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=not ok)
+        os.close(fd)
+    if not ok:
+        # yt-dlp would take a leftover file as already downloaded
+        os.remove(output_path)
+        return False
+
+    if progress_hook:
+        progress_hook({'status': 'finished', 'downloaded_bytes': size, 'total_bytes': size})
+    return True
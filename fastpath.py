@@ -0,0 +1,195 @@
+import struct
+
+import ffmpeg
+
+from ratecontrol import bitrate_budget, planned_short_side, run_ffmpeg, FRAGMENTED_MOVFLAGS
+
+# What compress_video should do with a downloaded source
+COPY = 'copy'            # already fits and plays everywhere: hand it back as is
+REMUX = 'remux'          # fits, wrong container or layout: stream copy into MP4
+AUDIO = 'audio'          # video fits, audio doesn't: re-encode the audio only
+TRANSCODE = 'transcode'  # full libx264/aac encode
+
+# Codecs we can hand to any browser/phone inside an MP4 untouched
+PLAYABLE_VIDEO = ('h264',)
+PLAYABLE_AUDIO = ('aac', 'mp3')
+# 8-bit 4:2:0; High 10 and 4:2:2/4:4:4 H.264 won't play on most devices
+PLAYABLE_PIX_FMTS = ('yuv420p', 'yuvj420p')
+# avc1.PPCCLL profile_idc for Baseline, Main, Extended and High
+PLAYABLE_AVC_PROFILES = ('42', '4d', '58', '64')
+
+# ffprobe calls MOV, 3GP and M4A "mp4" too; the major brand tells them apart
+MP4_BRANDS = ('isom', 'iso2', 'iso4', 'iso5', 'iso6', 'mp41', 'mp42', 'avc1', 'dash')
+
+
+def _first_stream(probe, kind):
+    return next((s for s in probe['streams'] if s['codec_type'] == kind), None)
+
+
+def _moov_first(path):
+    """
+    Whether the MP4 at `path` has its index ahead of the media data, so
+    players can start before the whole file has arrived.
+    """
+    try:
+        with open(path, 'rb') as f:
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    return False
+                size, kind = struct.unpack('>I4s', header)
+                if kind == b'moov':
+                    return True
+                if kind == b'mdat':
+                    return False
+                if size == 1:
+                    # 64-bit box size follows the type
+                    size = struct.unpack('>Q', f.read(8))[0] - 8
+                if size < 8:
+                    return False
+                f.seek(size - 8, 1)
+    except (OSError, struct.error):
+        return False
+
+
+def _is_web_mp4(fmt):
+    brand = (fmt.get('tags') or {}).get('major_brand', '').strip().lower()
+    return (
+        'mp4' in fmt.get('format_name', '').split(',')
+        and brand in MP4_BRANDS
+        and _moov_first(fmt.get('filename', ''))
+    )
+
+
+def choose_strategy(probe, target_bytes):
+    """
+    Pick the cheapest way to turn the probed source into a playable MP4
+    under `target_bytes`.
+    """
+    fmt = probe['format']
+    duration = float(fmt['duration'])
+    size = int(fmt.get('size') or 0)
+    video = _first_stream(probe, 'video')
+    audio = _first_stream(probe, 'audio')
+
+    if (video is None or video.get('codec_name') not in PLAYABLE_VIDEO
+            or video.get('pix_fmt') not in PLAYABLE_PIX_FMTS):
+        return TRANSCODE
+
+    audio_ok = audio is None or audio.get('codec_name') in PLAYABLE_AUDIO
+    if size and size <= target_bytes and audio_ok:
+        # Anything but a faststart MP4 gets a (cheap) remux with +faststart
+        return COPY if _is_web_mp4(fmt) else REMUX
+
+    # Containers like mkv don't always report per-stream bitrates, so fall
+    # back to whatever the audio doesn't account for
+    video_bps = int(video.get('bit_rate') or 0)
+    if not video_bps and size:
+        audio_bps = int((audio or {}).get('bit_rate') or 0)
+        video_bps = size * 8 / duration - audio_bps
+    budget_k, _ = bitrate_budget(duration, audio is not None, target_bytes)
+    if video_bps and video_bps / 1000 <= budget_k:
+        return AUDIO if audio is not None else REMUX
+
+    return TRANSCODE
+
+
+def remux(input_path, output_path, audio_bitrate_k=None, input_opts=None,
+          fragmented=False, duration=None, on_progress=None):
+    """
+    Stream copy the video into an MP4, re-encoding the audio to AAC at
+    `audio_bitrate_k` if given.
+
+    `fragmented` writes fragmented MP4 that can be read while it grows.
+    """
+    opts = {'vcodec': 'copy'}
+    if audio_bitrate_k:
+        opts.update(acodec='aac', audio_bitrate=f'{audio_bitrate_k}k', ac=2)
+    else:
+        opts['acodec'] = 'copy'
+    movflags = FRAGMENTED_MOVFLAGS if fragmented else '+faststart'
+    run_ffmpeg(
+        ffmpeg
+        .input(input_path, **(input_opts or {}))
+        .output(output_path, format='mp4', movflags=movflags, **opts),
+        duration=duration,
+        on_progress=on_progress,
+    )
+
+
+def is_stream_copyable(fmt, duration, target_bytes):
+    """
+    Whether a yt-dlp format can be stream copied as is: 8-bit H.264/AAC
+    and already under the target by its metadata.
+    """
+    size = _estimated_size(fmt, duration)
+    vcodec = (fmt.get('vcodec') or '').lower()
+    return bool(
+        size and size <= target_bytes
+        and (vcodec.startswith('h264')
+             or vcodec.startswith('avc1.') and vcodec[5:7] in PLAYABLE_AVC_PROFILES)
+        and (fmt.get('acodec') or '').startswith(('mp4a', 'aac'))
+    )
+
+
+def stream_input_options(fmt):
+    """
+    ffmpeg input options for reading a yt-dlp format from its URL with
+    the headers the extractor says it needs.
+    """
+    opts = {}
+    headers = fmt.get('http_headers') or {}
+    if headers:
+        opts['headers'] = ''.join(f"{k}: {v}\r\n" for k, v in headers.items())
+    if fmt.get('protocol') in ('http', 'https'):
+        # Ride out dropped connections instead of truncating the output
+        opts.update(reconnect=1, reconnect_streamed=1, reconnect_delay_max=5)
+    return opts
+
+
+def _estimated_size(fmt, duration):
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if not size and fmt.get('tbr') and duration:
+        size = fmt['tbr'] * 1000 / 8 * duration
+    return size
+
+
+def select_format(info, target_bytes):
+    """
+    Choose a yt-dlp format id from `info` that avoids downloading more
+    than we need, or None to keep the default selection.
+
+    If some format already fits under the target we take the best of
+    those, since it may need no encode at all. Otherwise we take the
+    smallest format that still has at least as many pixels as the encoder
+    will output.
+    """
+    duration = info.get('duration')
+    sized = []
+    for fmt in info.get('formats') or []:
+        # Progressive MP4 only, like the default "best[ext=mp4]"
+        if fmt.get('ext') != 'mp4' or 'none' in (fmt.get('vcodec'), fmt.get('acodec')):
+            continue
+        size = _estimated_size(fmt, duration)
+        if size:
+            sized.append((size, fmt))
+    if not sized or not duration:
+        return None
+
+    def quality(entry):
+        return (entry[1].get('height') or 0, entry[1].get('tbr') or 0)
+
+    fits = [entry for entry in sized if entry[0] <= target_bytes]
+    if fits:
+        return max(fits, key=quality)[1]['format_id']
+
+    _, best = max(sized, key=quality)
+    if not best.get('width') or not best.get('height'):
+        return None
+    side = planned_short_side(duration, best['width'], best['height'],
+                              best.get('fps') or 30, target_bytes)
+    enough = [
+        entry for entry in sized
+        if min(entry[1].get('width') or 0, entry[1].get('height') or 0) >= side
+    ]
+    return min(enough, key=lambda entry: entry[0])[1]['format_id']
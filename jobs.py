@@ -0,0 +1,231 @@
+import os
+import threading
+import time
+import uuid
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# Job lifecycle states, in the order a healthy job walks through them
+QUEUED = 'queued'
+DOWNLOADING = 'downloading'
+ENCODING = 'encoding'
+DONE = 'done'
+FAILED = 'failed'
+
+FINISHED_STATES = (DONE, FAILED)
+
+# Times a job is re-queued after a worker death took the pool down with it
+MAX_CRASH_RETRIES = 1
+
+
+class QueueFull(Exception):
+    """
+    Raised by JobQueue.submit when the pending-job limit has been reached.
+    """
+
+
+def update_job(jobs, job_id, **fields):
+    """
+    Merge `fields` into the shared record for `job_id`.
+
+    Manager dict proxies only notice assignment, so the record is copied,
+    updated and written back as a whole.
+    """
+    job = jobs.get(job_id)
+    if job is None:
+        return
+    job.update(fields)
+    jobs[job_id] = job
+
+
+# Inside pool workers: (shared pending counter, pool size), see current_load()
+_load = None
+
+
+def _init_worker(pending, workers, initializer, initargs):
+    global _load
+    _load = (pending, workers)
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def current_load():
+    """
+    (running, queued) job counts across the whole pool, as seen from
+    inside a worker. Outside the pool this reports a lone job.
+    """
+    if _load is None:
+        return 1, 0
+    pending, workers = _load
+    n = pending.value
+    return max(min(n, workers), 1), max(n - workers, 0)
+
+
+class JobQueue:
+    """
+    Bounded process pool that runs compression jobs in the background.
+
+    Job records live in a multiprocessing Manager dict so worker processes
+    can report their own state and progress back to the web process.
+    """
+
+    def __init__(self, workers=None, max_pending=None, initializer=None, initargs=()):
+        self.workers = workers or os.cpu_count() or 1
+        # Run in every worker, including those of a replacement pool. Shared
+        # objects (locks, semaphores) must travel through `initargs`, since
+        # only fork start methods would inherit module globals.
+        self.initializer = initializer
+        self.initargs = tuple(initargs)
+        # Jobs allowed to wait or run at once; beyond this submit() refuses
+        self.max_pending = max_pending or self.workers * 2
+        # Shared with the workers so they can size their encodes to the load
+        self._pending = multiprocessing.Value('i', 0)
+        self._executor = self._new_executor()
+        self._manager = multiprocessing.Manager()
+        self.jobs = self._manager.dict()
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, on_done=None, **fields):
+        """
+        Queue `fn(jobs, job_id, *args)` on the pool and return the new job id.
+
+        `on_done(job)` is called with the final job record once it finishes.
+        Extra `fields` are stored on the job record.
+        """
+        with self._lock:
+            if self._pending.value >= self.max_pending:
+                raise QueueFull(f"{self._pending.value} jobs already pending")
+            self._pending.value += 1
+
+        job_id = self._create(QUEUED, **fields)
+        try:
+            self._schedule(job_id, fn, args, on_done)
+        except Exception:
+            self._release()
+            del self.jobs[job_id]
+            raise
+        return job_id
+
+    def complete(self, result, **fields):
+        """
+        Record a job that is already done, e.g. one served from the cache,
+        without touching the pool.
+        """
+        job_id = self._create(DONE, progress=1.0, result=result,
+                              finished_at=time.time(), **fields)
+        return job_id
+
+    def get(self, job_id):
+        """
+        Return a snapshot of the job record, or None if the id is unknown.
+        """
+        job = self.jobs.get(job_id)
+        return dict(job) if job is not None else None
+
+    def pending(self):
+        return self._pending.value
+
+    def active_ids(self):
+        """
+        Ids of jobs that are still queued or running.
+        """
+        return {job_id for job_id, job in self.jobs.items()
+                if job['state'] not in FINISHED_STATES}
+
+    def prune(self, max_age):
+        """
+        Forget finished jobs older than `max_age` seconds; returns how many.
+        """
+        cutoff = time.time() - max_age
+        stale = [job_id for job_id, job in self.jobs.items()
+                 if job['state'] in FINISHED_STATES
+                 and (job.get('finished_at') or 0) < cutoff]
+        for job_id in stale:
+            self.jobs.pop(job_id, None)
+        return len(stale)
+
+    def _new_executor(self):
+        return ProcessPoolExecutor(
+            max_workers=self.workers,
+            initializer=_init_worker,
+            initargs=(self._pending, self.workers, self.initializer, self.initargs),
+        )
+
+    def _replace_executor(self, broken):
+        """
+        Swap in a fresh pool for `broken` unless another thread already did,
+        and return the current one.
+        """
+        with self._lock:
+            if self._executor is broken:
+                print("[jobs] process pool is broken, starting a new one")
+                broken.shutdown(wait=False, cancel_futures=True)
+                self._executor = self._new_executor()
+            return self._executor
+
+    def _schedule(self, job_id, fn, args, on_done):
+        executor = self._executor
+        try:
+            future = executor.submit(fn, self.jobs, job_id, *args)
+        except BrokenProcessPool:
+            future = self._replace_executor(executor).submit(fn, self.jobs, job_id, *args)
+        future.add_done_callback(
+            lambda f: self._finished(job_id, f, fn, args, on_done))
+
+    def _retry(self, job_id, fn, args, on_done):
+        # A dead worker breaks the whole pool, failing every job it held;
+        # give those another go on a fresh pool
+        job = self.get(job_id)
+        if job is None or job['attempts'] > MAX_CRASH_RETRIES:
+            return False
+        print(f"[jobs] re-queueing {job_id} after the pool broke")
+        update_job(self.jobs, job_id, state=QUEUED, progress=0.0, partial=None,
+                   attempts=job['attempts'] + 1)
+        try:
+            self._schedule(job_id, fn, args, on_done)
+        except Exception as e:
+            print(f"[jobs] could not re-queue {job_id}: {e!r}")
+            return False
+        return True
+
+    def _create(self, state, **fields):
+        job_id = str(uuid.uuid4())
+        self.jobs[job_id] = {
+            'id': job_id,
+            'state': state,
+            'progress': 0.0,
+            'error': None,
+            'result': None,
+            # Output file that can be streamed while the job is running
+            'partial': None,
+            # Seconds per pipeline stage and per-job measurements
+            'stages': {},
+            'stats': {},
+            # Source domain, used as a metrics label
+            'domain': None,
+            'created_at': time.time(),
+            'finished_at': None,
+            # Times the job has been handed to the pool
+            'attempts': 1,
+            **fields,
+        }
+        return job_id
+
+    def _release(self):
+        with self._lock:
+            self._pending.value -= 1
+
+    def _finished(self, job_id, future, fn, args, on_done):
+        exc = future.exception()
+        if isinstance(exc, BrokenProcessPool) and self._retry(job_id, fn, args, on_done):
+            return
+        self._release()
+        if exc is not None:
+            # The worker itself died (e.g. killed by the OOM killer)
+            print(f"[jobs] {job_id} crashed: {exc!r}")
+            update_job(self.jobs, job_id, state=FAILED,
+                       error='Compression failed due to an internal error.')
+        update_job(self.jobs, job_id, finished_at=time.time())
+        if on_done is not None:
+            on_done(self.get(job_id))
@@ -0,0 +1,206 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+from cache import normalize_url
+from jobs import update_job
+
+# Distinct source domains we label individually before lumping the rest
+# into "other", to keep series cardinality bounded
+MAX_DOMAINS = 50
+
+STAGE_BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, 1800)
+SIZE_RATIO_BUCKETS = (0.5, 0.7, 0.8, 0.9, 0.95, 1.0, 1.05, 1.2, 1.5)
+SPEED_BUCKETS = (0.25, 0.5, 1, 2, 4, 8, 16, 32)
+BITRATE_BUCKETS = (64, 128, 256, 512, 1000, 2000, 4000, 8000)
+DURATION_BUCKETS = (5, 15, 30, 60, 120, 300, 600, 1800, 3600)
+BYTES_BUCKETS = tuple(mb * 1024 * 1024 for mb in (1, 5, 10, 25, 50, 100, 250, 500, 1000))
+HEIGHT_BUCKETS = (240, 360, 480, 720, 1080, 1440, 2160)
+
+
+def _escape(value):
+    # Label values may come from user input (source hostnames)
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _label_text(labels):
+    if not labels:
+        return ''
+    inner = ','.join(f'{k}="{_escape(v)}"' for k, v in labels)
+    return '{' + inner + '}'
+
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_label_text(key)} {value}")
+        return lines
+
+
+class Gauge:
+    """
+    Gauge read from `fn()` at scrape time.
+    """
+
+    def __init__(self, name, help_text, fn):
+        self.name = name
+        self.help = help_text
+        self.fn = fn
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge",
+                f"{self.name} {self.fn()}"]
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts, total, count = self._values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                for bound, n in zip(self.buckets + ('+Inf',), counts + [count]):
+                    lines.append(f"{self.name}_bucket{_label_text(key + (('le', bound),))} {n}")
+                lines.append(f"{self.name}_sum{_label_text(key)} {total}")
+                lines.append(f"{self.name}_count{_label_text(key)} {count}")
+        return lines
+
+
+REGISTRY = []
+
+
+def register(metric):
+    REGISTRY.append(metric)
+    return metric
+
+
+def render():
+    """
+    All registered metrics in the Prometheus text exposition format.
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+stage_seconds = register(Histogram(
+    'smolfile_stage_seconds', 'Time spent in each job stage.', STAGE_BUCKETS))
+job_seconds = register(Histogram(
+    'smolfile_job_seconds', 'End-to-end worker time per job.', STAGE_BUCKETS))
+jobs_total = register(Counter(
+    'smolfile_jobs_total', 'Finished jobs by outcome and strategy.'))
+downloaded_bytes = register(Histogram(
+    'smolfile_downloaded_bytes', 'Source bytes downloaded per job.', BYTES_BUCKETS))
+source_duration = register(Histogram(
+    'smolfile_source_duration_seconds', 'Duration of source videos.', DURATION_BUCKETS))
+source_height = register(Histogram(
+    'smolfile_source_height_pixels', 'Short side of source videos.', HEIGHT_BUCKETS))
+video_bitrate = register(Histogram(
+    'smolfile_video_bitrate_kbps', 'Video bitrate chosen by rate control.', BITRATE_BUCKETS))
+output_ratio = register(Histogram(
+    'smolfile_output_size_ratio', 'Output size divided by the target size.', SIZE_RATIO_BUCKETS))
+encode_speed = register(Histogram(
+    'smolfile_encode_speed_ratio', 'Source seconds encoded per wall-clock second.', SPEED_BUCKETS))
+
+_domains = set()
+_domains_lock = threading.Lock()
+
+
+def domain_label(url):
+    """
+    Source domain of `url` for metric labels, bounded to MAX_DOMAINS values.
+    """
+    host = urlparse(normalize_url(url)).hostname or 'unknown'
+    with _domains_lock:
+        if host not in _domains and len(_domains) >= MAX_DOMAINS:
+            return 'other'
+        _domains.add(host)
+    return host
+
+
+class StageTimer:
+    """
+    Per-job stage timings and stats, written into the shared job record so
+    the web process can turn them into metrics when the job finishes.
+    """
+
+    def __init__(self, jobs, job_id):
+        self.jobs = jobs
+        self.job_id = job_id
+        self.stages = {}
+        self.stats = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.monotonic() - start
+            update_job(self.jobs, self.job_id, stages=dict(self.stages))
+
+    def note(self, **stats):
+        self.stats.update({k: v for k, v in stats.items() if v is not None})
+        update_job(self.jobs, self.job_id, stats=dict(self.stats))
+
+
+def observe_job(job):
+    """
+    Fold a finished job record into the metrics and log it as one line.
+    """
+    domain = job.get('domain') or 'unknown'
+    stages, stats = job.get('stages') or {}, job.get('stats') or {}
+    strategy = stats.get('strategy', 'none')
+    jobs_total.inc(outcome=job['state'], strategy=strategy)
+
+    for name, seconds in stages.items():
+        stage_seconds.observe(seconds, stage=name, domain=domain)
+    if stages:
+        job_seconds.observe(sum(stages.values()), domain=domain, outcome=job['state'])
+
+    if 'downloaded_bytes' in stats:
+        downloaded_bytes.observe(stats['downloaded_bytes'], domain=domain)
+    if 'source_duration' in stats:
+        source_duration.observe(stats['source_duration'], domain=domain)
+    if 'source_width' in stats and 'source_height' in stats:
+        source_height.observe(min(stats['source_width'], stats['source_height']))
+    if 'video_bitrate_k' in stats:
+        video_bitrate.observe(stats['video_bitrate_k'])
+    if 'output_bytes' in stats and 'target_bytes' in stats:
+        output_ratio.observe(stats['output_bytes'] / stats['target_bytes'], strategy=strategy)
+    encode_time = stages.get('encode') or stages.get('stream')
+    if encode_time and 'source_duration' in stats:
+        encode_speed.observe(stats['source_duration'] / encode_time, strategy=strategy,
+                             preset=stats.get('preset', 'none'))
+
+    print(f"[metrics] {json.dumps({'id': job['id'], 'state': job['state'], 'domain': domain, 'stages': stages, 'stats': stats})}")
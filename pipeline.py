@@ -0,0 +1,339 @@
+import os
+import traceback
+
+import ffmpeg
+
+import browser
+from browser import needs_browser, refresh_cookies, site_for
+import download
+from download import cached_extract, parallel_download, FRAGMENT_CONCURRENCY
+from jobs import update_job, DOWNLOADING, ENCODING, DONE, FAILED
+from fastpath import (
+    choose_strategy, is_stream_copyable, remux, select_format, stream_input_options,
+    COPY, REMUX, AUDIO,
+)
+from metrics import StageTimer
+from scheduler import encoder_settings
+from ratecontrol import bitrate_budget, encode_stream, encode_to_target, plan_from_format
+
+# Directory to store videos
+OUTPUT_DIR = "compressed_videos"
+os.makedirs(OUTPUT_DIR, exist_ok=True)
+
+# Target size: 10MB
+TARGET_SIZE_MB = 10
+TARGET_SIZE_BYTES = TARGET_SIZE_MB * 1024 * 1024
+
+# Spend an extra analysis pass for tighter size accuracy
+TWO_PASS = os.environ.get('TWO_PASS', '') == '1'
+
+# Let ffmpeg read the source while it downloads and stream the output as
+# fragmented MP4, instead of download-then-encode
+PIPELINE = os.environ.get('PIPELINE', '') == '1'
+# Protocols ffmpeg can read straight from the resolved media URL
+STREAMABLE_PROTOCOLS = ('http', 'https', 'm3u8', 'm3u8_native')
+
+# Cached extract_info results, shared by all workers
+INFO_CACHE_DIR = os.path.join(OUTPUT_DIR, ".info")
+# Browser-harvested cookies for BROWSER_DOMAINS, one file per site
+COOKIE_DIR = os.path.join(OUTPUT_DIR, ".cookies")
+
+YDL_OPTS = {
+    "format": "best[ext=mp4]",
+    "quiet": True,
+    "nocheckcertificate": True,
+    "geo_bypass": True,
+    "restrictfilenames": True,
+    "noplaylist": True,
+    "concurrent_fragment_downloads": FRAGMENT_CONCURRENCY,
+}
+
+
+def worker_state():
+    """
+    Limits shared by every pool worker. Create them in the web process and
+    pass them as the pool's initargs for init_worker(), which works with
+    any multiprocessing start method.
+    """
+    return browser.page_slots(), download.shared_host_slots()
+
+
+def init_worker(page_slots, host_slots):
+    browser.init_worker(page_slots)
+    download.init_worker(host_slots)
+
+
+def cookie_path(url):
+    return os.path.join(COOKIE_DIR, f"{site_for(url)}.txt")
+
+
+def ydl_options(url, **extra):
+    """
+    YDL_OPTS plus `extra`, with browser cookies for `url` if we have any.
+    """
+    opts = dict(YDL_OPTS, **extra)
+    if needs_browser(url) and os.path.exists(cookie_path(url)):
+        opts["cookiefile"] = cookie_path(url)
+    return opts
+
+
+def extract_video(url):
+    """
+    Run yt-dlp extraction for `url` without downloading anything.
+
+    For BROWSER_DOMAINS a failed extraction is retried once with cookies
+    from a real browser visit.
+    """
+    from yt_dlp.utils import DownloadError
+
+    try:
+        return cached_extract(url, ydl_options(url), INFO_CACHE_DIR)
+    except DownloadError:
+        if not needs_browser(url):
+            raise
+        print(f"[yt-dlp] extraction failed for {url}, retrying with browser cookies")
+        refresh_cookies(url, cookie_path(url))
+        return cached_extract(url, ydl_options(url), INFO_CACHE_DIR)
+
+
+def chosen_format(info):
+    """
+    Return (format_id, format) that select_format() picks from `info`.
+
+    format_id is None when we keep yt-dlp's own choice, in which case
+    `info` itself carries that format's fields.
+    """
+    format_id = select_format(info, TARGET_SIZE_BYTES)
+    fmt = next(
+        (f for f in info.get('formats') or [] if f.get('format_id') == format_id),
+        info,
+    )
+    return format_id, fmt
+
+
+def resolve_stream(info):
+    """
+    Return the format from `info` that ffmpeg should read directly, or
+    None if the source needs yt-dlp's own downloader.
+    """
+    _, fmt = chosen_format(info)
+    if not info.get('duration') or not fmt.get('url'):
+        return None
+    if fmt.get('protocol') not in STREAMABLE_PROTOCOLS:
+        return None
+    # yt-dlp keeps cookies out of http_headers and ffmpeg never sees them
+    if fmt.get('cookies'):
+        return None
+    return fmt
+
+
+def download_video(url, output_path, progress_hook=None, info=None):
+    """
+    Download the video at `url` into output_path.
+
+    Plain HTTP sources are fetched as parallel byte ranges; anything else,
+    or a server that won't do ranges, goes through yt-dlp. Pass `info`
+    from extract_video() to skip a second extraction.
+    """
+    print(f"[yt-dlp] downloading {url} to {output_path}")
+    if info is None:
+        info = extract_video(url)
+    format_id, fmt = chosen_format(info)
+    if format_id:
+        print(f"[yt-dlp] picked format {format_id} for {url}")
+
+    if (fmt.get('protocol') in ('http', 'https') and not fmt.get('cookies')
+            and parallel_download(fmt, output_path, progress_hook)):
+        print(f"[download] saved to {output_path}")
+        return
+
+    from yt_dlp import YoutubeDL
+
+    ydl_opts = ydl_options(url, outtmpl=output_path)
+    if progress_hook:
+        ydl_opts["progress_hooks"] = [progress_hook]
+    with YoutubeDL(ydl_opts) as ydl:
+        if format_id:
+            ydl.format_selector = ydl.build_format_selector(format_id)
+        ydl.process_ie_result(info, download=True)
+    print(f"[yt-dlp] saved to {output_path}")
+
+
+def source_stats(probe):
+    """
+    Duration and picture size of a probed source, for job stats.
+    """
+    video = next((st for st in probe['streams'] if st['codec_type'] == 'video'), {})
+    return {
+        'source_duration': float(probe['format']['duration']),
+        'source_width': video.get('width'),
+        'source_height': video.get('height'),
+    }
+
+
+def compress_video(input_path, output_path, probe=None, on_progress=None):
+    """
+    Compress input_path to output_path targeting under 10MB, skipping as
+    much of the encode as the source allows.
+
+    Returns stats about what was done: the strategy and chosen bitrates.
+    """
+    if probe is None:
+        print(f"[compress_video] probing {input_path}")
+        probe = ffmpeg.probe(input_path)
+    duration = float(probe['format']['duration'])
+    strategy = choose_strategy(probe, TARGET_SIZE_BYTES)
+    print(f"[compress_video] strategy: {strategy}")
+
+    if strategy == COPY:
+        # The raw file is thrown away afterwards, so just move it
+        os.replace(input_path, output_path)
+        print(f"[compress_video] output saved to {output_path}")
+        return {'strategy': strategy}
+
+    if strategy in (REMUX, AUDIO):
+        audio_k = None
+        if strategy == AUDIO:
+            _, audio_k = bitrate_budget(duration, True, TARGET_SIZE_BYTES)
+        remux(input_path, output_path, audio_bitrate_k=audio_k,
+              duration=duration, on_progress=on_progress)
+        if os.path.getsize(output_path) <= TARGET_SIZE_BYTES:
+            print(f"[compress_video] output saved to {output_path}")
+            return {'strategy': strategy, 'audio_bitrate_k': audio_k}
+        print(f"[compress_video] {strategy} came out too big, transcoding")
+
+    encoder = encoder_settings()
+    print(f"[compress_video] encoder: {encoder}")
+    plan = encode_to_target(input_path, output_path, probe, TARGET_SIZE_BYTES,
+                            two_pass=TWO_PASS, on_progress=on_progress,
+                            encoder=encoder)
+    print(f"[compress_video] output saved to {output_path}")
+    return {
+        'strategy': 'transcode',
+        'video_bitrate_k': plan['video_bitrate_k'],
+        'audio_bitrate_k': plan['audio_bitrate_k'],
+        **encoder,
+    }
+
+
+def stream_video(fmt, duration, output_path, on_progress=None):
+    """
+    Read the source format straight from its URL and write fragmented MP4
+    to output_path as it goes, so it can be served before it finishes.
+
+    Returns the same kind of stats as compress_video().
+    """
+    print(f"[stream_video] streaming format {fmt.get('format_id')} to {output_path}")
+    input_opts = stream_input_options(fmt)
+    if is_stream_copyable(fmt, duration, TARGET_SIZE_BYTES):
+        print("[stream_video] strategy: remux")
+        remux(fmt['url'], output_path, input_opts=input_opts, fragmented=True,
+              duration=duration, on_progress=on_progress)
+        stats = {'strategy': 'remux'}
+    else:
+        print("[stream_video] strategy: transcode")
+        encoder = encoder_settings()
+        plan = dict(plan_from_format(fmt, duration, TARGET_SIZE_BYTES), **encoder)
+        encode_stream(fmt['url'], output_path, plan, input_opts=input_opts,
+                      on_progress=on_progress)
+        stats = {
+            'strategy': 'transcode',
+            'video_bitrate_k': plan['video_bitrate_k'],
+            'audio_bitrate_k': plan['audio_bitrate_k'],
+            **encoder,
+        }
+    print(f"[stream_video] output saved to {output_path}")
+    return stats
+
+
+def process_job(jobs, job_id, url, output_path):
+    """
+    Worker entry point: download `url` and compress it into output_path,
+    reporting state, progress and per-stage timings into the shared `jobs`
+    dict as it goes.
+    """
+    # Working files are per attempt: an encode orphaned by a crashed
+    # attempt must never share a file with the retry
+    attempt = jobs[job_id].get('attempts', 1)
+    raw = os.path.join(OUTPUT_DIR, f"{job_id}_{attempt}_raw.mp4")
+    # Encode next to the destination and rename at the end, so a cached
+    # path never holds a half-written file
+    small = os.path.join(OUTPUT_DIR, f"{job_id}_{attempt}_smol.mp4")
+    timer = StageTimer(jobs, job_id)
+
+    def on_download(d):
+        total = d.get('total_bytes') or d.get('total_bytes_estimate')
+        if d.get('status') == 'downloading' and total:
+            update_job(jobs, job_id,
+                       progress=min(d.get('downloaded_bytes', 0) / total, 1.0))
+
+    def on_encode(fraction):
+        update_job(jobs, job_id, progress=fraction)
+
+    try:
+        update_job(jobs, job_id, state=DOWNLOADING, progress=0.0)
+        with timer.stage('extract'):
+            info = extract_video(url)
+        fmt = resolve_stream(info) if PIPELINE else None
+        if fmt is not None:
+            duration = float(info['duration'])
+            timer.note(source_duration=duration, source_width=fmt.get('width'),
+                       source_height=fmt.get('height'))
+            # Download and encode overlap; expose the growing output
+            update_job(jobs, job_id, state=ENCODING, partial=small)
+            try:
+                with timer.stage('stream'):
+                    timer.note(**stream_video(fmt, duration, small, on_progress=on_encode))
+                streamed = os.path.getsize(small)
+            except ffmpeg.Error:
+                # Expired URL, dropped connection, a source ffmpeg can't
+                # read directly; yt-dlp's downloader may still manage
+                traceback.print_exc()
+                streamed = None
+            if streamed is None or streamed > TARGET_SIZE_BYTES:
+                # A streamed encode can't be corrected and a remux rests on
+                # estimated sizes; redo it properly rather than cache it
+                if streamed is None:
+                    print("[process_job] streaming failed; falling back to download and encode")
+                else:
+                    print(f"[process_job] streamed output is {streamed} bytes, over "
+                          f"{TARGET_SIZE_BYTES}; falling back to download and encode")
+                    timer.note(streamed_bytes=streamed)
+                if os.path.exists(small):
+                    os.remove(small)
+                update_job(jobs, job_id, state=DOWNLOADING, progress=0.0, partial=None)
+                fmt = None
+        if fmt is None:
+            with timer.stage('download'):
+                download_video(url, raw, progress_hook=on_download, info=info)
+            timer.note(downloaded_bytes=os.path.getsize(raw))
+            with timer.stage('probe'):
+                probe = ffmpeg.probe(raw)
+            timer.note(**source_stats(probe))
+            update_job(jobs, job_id, state=ENCODING, progress=0.0)
+            with timer.stage('encode'):
+                timer.note(**compress_video(raw, small, probe=probe, on_progress=on_encode))
+        timer.note(output_bytes=os.path.getsize(small), target_bytes=TARGET_SIZE_BYTES)
+        os.replace(small, output_path)
+    except ValueError as ve:
+        # Bad URL, or a source we can't fit under the target
+        update_job(jobs, job_id, state=FAILED, error=str(ve))
+        return
+    except FileNotFoundError:
+        # Likely ffprobe is missing
+        update_job(jobs, job_id, state=FAILED,
+                   error='Server misconfiguration: ffmpeg/ffprobe not found on the host.')
+        return
+    except Exception:
+        # print the real stack to the logs
+        traceback.print_exc()
+        update_job(jobs, job_id, state=FAILED,
+                   error='Compression failed due to an internal error.')
+        return
+    finally:
+        # clean up raw file, and the partial output if we failed
+        for path in (raw, small):
+            if os.path.exists(path):
+                os.remove(path)
+
+    update_job(jobs, job_id, state=DONE, progress=1.0, result=output_path)
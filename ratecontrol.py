@@ -0,0 +1,317 @@
+import ctypes
+import ctypes.util
+import os
+import signal
+import subprocess
+
+import ffmpeg
+
+# Audio budget: AAC stereo, squeezed down for long clips
+AUDIO_BITRATE_K = 96
+MIN_AUDIO_BITRATE_K = 32
+# Never spend more than this share of the budget on audio
+MAX_AUDIO_SHARE = 0.10
+
+# MP4 muxing cost: moov/index tables plus per-sample headers
+OVERHEAD_BYTES = 64 * 1024
+OVERHEAD_FRACTION = 0.02
+
+# Headroom left under the target to absorb encoder rate error
+SAFETY_MARGIN = 0.03
+
+# VBV: cap peaks relative to the average so no section blows the budget
+MAXRATE_FACTOR = 1.5
+BUFSIZE_FACTOR = 2.0
+
+# Below this many bits per pixel per frame x264 falls apart, so we step
+# the resolution/framerate down instead
+MIN_BITS_PER_PIXEL = 0.04
+# Short-side heights to try when stepping down
+RESOLUTION_LADDER = (1080, 720, 540, 480, 360, 240)
+MIN_VIDEO_BITRATE_K = 64
+
+# Fragmented MP4: playable while still being written
+FRAGMENTED_MOVFLAGS = '+frag_keyframe+empty_moov+default_base_moof'
+
+# How many corrected re-encodes we allow if the output is still too big
+MAX_CORRECTIONS = 1
+
+# prctl(PR_SET_PDEATHSIG) on Linux; loaded up front since the child must
+# not import or dlopen anything between fork and exec
+PR_SET_PDEATHSIG = 1
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _prctl = _libc.prctl
+except (OSError, AttributeError):
+    _prctl = None
+
+
+def _frame_rate(stream):
+    for field in ('avg_frame_rate', 'r_frame_rate'):
+        num, _, den = stream.get(field, '0/0').partition('/')
+        try:
+            fps = float(num) / float(den or 1)
+        except (ValueError, ZeroDivisionError):
+            continue
+        if fps > 0:
+            return fps
+    return 30.0
+
+
+def _pick_geometry(video_bps, width, height, fps):
+    """
+    Return (short_side, fps) for the largest picture the bitrate can carry,
+    or (None, None) if the source can stay as it is.
+    """
+    short = min(width, height)
+
+    def bpp(side, rate):
+        scale = side / short
+        return video_bps / (width * scale * height * scale * rate)
+
+    if bpp(short, fps) >= MIN_BITS_PER_PIXEL:
+        return None, None
+
+    capped = min(fps, 30)
+    for side in RESOLUTION_LADDER:
+        if side < short and bpp(side, capped) >= MIN_BITS_PER_PIXEL:
+            return side, capped
+    # Nothing fits: smallest rung at film framerate and accept the softness
+    side = min(RESOLUTION_LADDER[-1], short)
+    return side, min(fps, 24)
+
+
+def bitrate_budget(duration, has_audio, target_bytes):
+    """
+    Split the target into (video_k, audio_k) kbit/s for a `duration`
+    second clip, after container overhead and safety margin.
+    """
+    budget_bits = (target_bytes * (1 - OVERHEAD_FRACTION - SAFETY_MARGIN)
+                   - OVERHEAD_BYTES) * 8
+    total_k = budget_bits / duration / 1000
+
+    audio_k = 0
+    if has_audio:
+        audio_k = min(AUDIO_BITRATE_K, total_k * MAX_AUDIO_SHARE)
+        audio_k = int(max(audio_k, MIN_AUDIO_BITRATE_K))
+    return int(total_k - audio_k), audio_k
+
+
+def planned_short_side(duration, width, height, fps, target_bytes):
+    """
+    Short side of the picture the encoder will output for a source of
+    this shape, so callers can avoid fetching more pixels than that.
+    """
+    video_k, _ = bitrate_budget(duration, True, target_bytes)
+    side, _ = _pick_geometry(max(video_k, 1) * 1000, width, height, fps)
+    return side or min(width, height)
+
+
+def plan_encode(probe, target_bytes):
+    """
+    Work out encoder settings that land `probe`'s source under
+    `target_bytes`.
+
+    Returns a dict with video/audio bitrates (kbit/s), VBV limits and the
+    optional scale filter and output framerate.
+    """
+    duration = float(probe['format']['duration'])
+    video = next(s for s in probe['streams'] if s['codec_type'] == 'video')
+    has_audio = any(s['codec_type'] == 'audio' for s in probe['streams'])
+
+    video_k, audio_k = bitrate_budget(duration, has_audio, target_bytes)
+    if video_k < MIN_VIDEO_BITRATE_K:
+        raise ValueError(
+            f"Video is too long ({duration:.0f}s) to fit under "
+            f"{target_bytes // (1024 * 1024)}MB."
+        )
+
+    width, height = int(video['width']), int(video['height'])
+    side, fps = _pick_geometry(video_k * 1000, width, height, _frame_rate(video))
+    scale = None
+    if side is not None:
+        scale = f"scale=-2:{side}" if width >= height else f"scale={side}:-2"
+
+    return {
+        'duration': duration,
+        'video_bitrate_k': video_k,
+        'audio_bitrate_k': audio_k,
+        'maxrate_k': int(video_k * MAXRATE_FACTOR),
+        'bufsize_k': int(video_k * BUFSIZE_FACTOR),
+        'scale': scale,
+        'fps': fps,
+    }
+
+
+def _kill_with_parent(parent_pid):
+    """
+    preexec_fn for encoder processes: SIGKILL the child when the worker
+    that started it dies, so a crashed or terminated worker can't leave
+    an encode running against its files.
+    """
+    def preexec():
+        if _prctl is not None:
+            _prctl(PR_SET_PDEATHSIG, signal.SIGKILL, 0, 0, 0)
+        # The worker may have died before prctl took effect
+        if os.getppid() != parent_pid:
+            os._exit(1)
+    return preexec
+
+
+def run_ffmpeg(stream, duration=None, on_progress=None, quiet=False):
+    """
+    Run an ffmpeg-python stream, reporting the fraction of `duration`
+    encoded so far to `on_progress` from ffmpeg's -progress output.
+
+    ffmpeg is killed if the calling process dies.
+    """
+    report = on_progress is not None and duration
+    if report:
+        stream = stream.global_args('-progress', 'pipe:1', '-nostats')
+        stdout = subprocess.PIPE
+    else:
+        stdout = subprocess.DEVNULL if quiet else None
+    proc = subprocess.Popen(
+        ffmpeg.compile(stream, overwrite_output=True),
+        stdout=stdout,
+        stderr=subprocess.DEVNULL if quiet else None,
+        preexec_fn=_kill_with_parent(os.getpid()),
+    )
+    if report:
+        for line in proc.stdout:
+            key, _, value = line.decode('utf-8', 'replace').strip().partition('=')
+            if key == 'out_time_us' and value.isdigit():
+                on_progress(min(int(value) / 1e6 / duration, 1.0))
+            elif key == 'progress' and value == 'end':
+                on_progress(1.0)
+    if proc.wait() != 0:
+        raise ffmpeg.Error('ffmpeg', None, None)
+
+
+def plan_from_format(fmt, duration, target_bytes):
+    """
+    plan_encode() for a source we haven't downloaded, from the yt-dlp
+    format metadata instead of an ffprobe result.
+    """
+    streams = [{
+        'codec_type': 'video',
+        'width': fmt.get('width') or 1280,
+        'height': fmt.get('height') or 720,
+        'avg_frame_rate': f"{fmt.get('fps') or 30}/1",
+    }]
+    if fmt.get('acodec') != 'none':
+        streams.append({'codec_type': 'audio'})
+    return plan_encode({'format': {'duration': duration}, 'streams': streams},
+                       target_bytes)
+
+
+def _video_options(plan):
+    opts = {
+        'vcodec': 'libx264',
+        'video_bitrate': f"{plan['video_bitrate_k']}k",
+        'maxrate': f"{plan['maxrate_k']}k",
+        'bufsize': f"{plan['bufsize_k']}k",
+        'pix_fmt': 'yuv420p',
+    }
+    if plan['scale']:
+        opts['vf'] = plan['scale']
+    if plan['fps']:
+        opts['r'] = plan['fps']
+    if plan.get('preset'):
+        opts['preset'] = plan['preset']
+    if plan.get('threads'):
+        opts['threads'] = plan['threads']
+    return opts
+
+
+def _run_encode(input_path, output_path, plan, passlog=None,
+                input_opts=None, fragmented=False, on_progress=None):
+    opts = _video_options(plan)
+    input_opts = input_opts or {}
+    if passlog:
+        # Analysis pass: video only, thrown away
+        run_ffmpeg(
+            ffmpeg
+            .input(input_path)
+            .output(os.devnull, format='null', an=None,
+                    **opts, **{'pass': 1, 'passlogfile': passlog}),
+            quiet=True,
+        )
+    if passlog:
+        opts.update({'pass': 2, 'passlogfile': passlog})
+
+    if plan['audio_bitrate_k']:
+        opts.update(acodec='aac', audio_bitrate=f"{plan['audio_bitrate_k']}k", ac=2)
+    else:
+        opts['an'] = None
+    movflags = FRAGMENTED_MOVFLAGS if fragmented else '+faststart'
+    run_ffmpeg(
+        ffmpeg
+        .input(input_path, **input_opts)
+        .output(output_path, format='mp4', movflags=movflags, **opts),
+        duration=plan['duration'],
+        on_progress=on_progress,
+    )
+
+
+def encode_stream(source, output_path, plan, input_opts=None, on_progress=None):
+    """
+    Single-pass encode of `source` (usually a URL) into fragmented MP4.
+
+    The output is being read while it is written, so there is no second
+    pass and no size correction; callers must check the size afterwards.
+    """
+    print(f"[ratecontrol] streaming plan: {plan}")
+    _run_encode(source, output_path, plan, input_opts=input_opts, fragmented=True,
+                on_progress=on_progress)
+    print(f"[ratecontrol] streamed {os.path.getsize(output_path)} bytes")
+
+
+def encode_to_target(input_path, output_path, probe, target_bytes, two_pass=False,
+                     on_progress=None, encoder=None):
+    """
+    Encode input_path into output_path at or under `target_bytes`.
+
+    The first encode uses the planned bitrate. If the result still comes
+    out too big, the video bitrate is scaled by the measured overshoot and
+    re-encoded, at most MAX_CORRECTIONS times. Two-pass mode already spends
+    its second encode on accuracy, so it gets no corrections. `encoder`
+    carries the x264 preset/threads from the scheduler. Returns the final
+    plan; raises ValueError if the output can't be brought under the target.
+    """
+    plan = plan_encode(probe, target_bytes)
+    plan.update(encoder or {})
+    passlog = f"{output_path}.passlog" if two_pass else None
+    corrections = 0 if two_pass else MAX_CORRECTIONS
+    print(f"[ratecontrol] plan: {plan}")
+
+    try:
+        for attempt in range(corrections + 1):
+            _run_encode(input_path, output_path, plan, passlog, on_progress=on_progress)
+            size = os.path.getsize(output_path)
+            print(f"[ratecontrol] attempt {attempt + 1}: {size} bytes "
+                  f"(target {target_bytes})")
+            if size <= target_bytes:
+                return plan
+            if attempt == corrections:
+                break
+
+            # Audio is CBR and accurate; put the whole miss on the video
+            audio_bits = plan['audio_bitrate_k'] * 1000 * plan['duration']
+            allowed = target_bytes * (1 - SAFETY_MARGIN) * 8 - audio_bits
+            spent = size * 8 - audio_bits
+            factor = max(allowed / spent, 0.5)
+            plan['video_bitrate_k'] = int(plan['video_bitrate_k'] * factor)
+            plan['maxrate_k'] = int(plan['video_bitrate_k'] * MAXRATE_FACTOR)
+            plan['bufsize_k'] = int(plan['video_bitrate_k'] * BUFSIZE_FACTOR)
+    finally:
+        if passlog:
+            for suffix in ('-0.log', '-0.log.mbtree', '-0.log.temp', '-0.log.mbtree.temp'):
+                if os.path.exists(passlog + suffix):
+                    os.remove(passlog + suffix)
+
+    print(f"[ratecontrol] still {size - target_bytes} bytes over "
+          f"after {corrections} corrections")
+    raise ValueError(
+        f"Could not compress the video under {target_bytes // (1024 * 1024)}MB."
+    )
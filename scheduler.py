@@ -0,0 +1,27 @@
+import os
+
+from jobs import current_load
+
+# x264 presets from best compression to fastest, as the backlog grows
+PRESETS = ('medium', 'fast', 'faster', 'veryfast')
+# Queued jobs per worker at which we move one preset faster
+BACKLOG_STEP = 0.5
+
+
+def encoder_settings(running=None, queued=None, cores=None):
+    """
+    Pick the x264 preset and thread count for an encode starting now.
+
+    The cores are split between the encodes running at once instead of
+    every ffmpeg grabbing all of them, and the preset gets faster as jobs
+    pile up behind us, giving up a little compression for throughput.
+    """
+    if running is None or queued is None:
+        running, queued = current_load()
+    cores = cores or os.cpu_count() or 1
+
+    threads = max(cores // max(running, 1), 1)
+    backlog = queued / max(running, 1)
+    step = 0 if queued == 0 else 1 + int(backlog / BACKLOG_STEP)
+    preset = PRESETS[min(step, len(PRESETS) - 1)]
+    return {'preset': preset, 'threads': threads}
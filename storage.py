@@ -0,0 +1,106 @@
+import os
+import re
+import shutil
+import threading
+import time
+import traceback
+
+from download import INFO_TTL_SECONDS
+
+# Cached outputs nobody has asked for in this long are deleted
+CACHE_TTL_SECONDS = int(os.environ.get('CACHE_TTL_SECONDS', 24 * 3600))
+# Finished job records (and their result links) are forgotten after this
+JOB_TTL_SECONDS = int(os.environ.get('JOB_TTL_SECONDS', 3600))
+# Keep at least this much disk free, evicting cached outputs if needed
+MIN_FREE_BYTES = int(os.environ.get('MIN_FREE_BYTES', 1024 * 1024 * 1024))
+# Leftover job files younger than this are left alone
+ORPHAN_GRACE_SECONDS = 600
+GC_INTERVAL_SECONDS = int(os.environ.get('GC_INTERVAL_SECONDS', 300))
+
+# Working files a job writes: <job id>_<attempt>_raw.mp4,
+# <job id>_<attempt>_smol.mp4 and the two-pass logs next to it
+JOB_FILE_RE = re.compile(
+    r'^([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})_'
+)
+
+
+class StorageManager:
+    """
+    Periodic garbage collection of everything the pipeline leaves on disk:
+    expired or over-quota cached outputs, working files of jobs that are no
+    longer running, stale extract_info results and old job records.
+    """
+
+    def __init__(self, cache, queue, directory, info_dir):
+        self.cache = cache
+        self.queue = queue
+        self.directory = directory
+        self.info_dir = info_dir
+        self._thread = None
+
+    def start(self, interval=GC_INTERVAL_SECONDS):
+        """
+        Run collect() every `interval` seconds on a daemon thread.
+        """
+        def loop():
+            while True:
+                try:
+                    self.collect()
+                except Exception:
+                    traceback.print_exc()
+                time.sleep(interval)
+
+        self._thread = threading.Thread(target=loop, name='storage-gc', daemon=True)
+        self._thread.start()
+
+    def collect(self):
+        """
+        One GC pass; returns what was removed.
+        """
+        report = {
+            'expired': self.cache.expire(CACHE_TTL_SECONDS),
+            'orphans': self._sweep_orphans(),
+            'info': self._sweep_dir(self.info_dir, INFO_TTL_SECONDS),
+            'freed_bytes': 0,
+        }
+
+        free = shutil.disk_usage(self.directory).free
+        if free < MIN_FREE_BYTES:
+            report['freed_bytes'] = self.cache.shrink(MIN_FREE_BYTES - free)
+
+        report['jobs'] = self.queue.prune(JOB_TTL_SECONDS)
+        if any(report.values()):
+            print(f"[storage] gc: {report}")
+        return report
+
+    def _sweep_orphans(self):
+        active = self.queue.active_ids()
+        cutoff = time.time() - ORPHAN_GRACE_SECONDS
+        removed = 0
+        for name in os.listdir(self.directory):
+            match = JOB_FILE_RE.match(name)
+            if not match or match[1] in active:
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
+
+    def _sweep_dir(self, directory, max_age):
+        if not os.path.isdir(directory):
+            return 0
+        cutoff = time.time() - max_age
+        removed = 0
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
@@ -0,0 +1,44 @@
+from cache import cache_key, normalize_url
+
+
+def test_share_link_variants_match():
+    canonical = normalize_url('https://www.youtube.com/watch?v=abc123')
+    assert normalize_url('https://youtu.be/abc123?si=xyz') == canonical
+    assert normalize_url('http://m.youtube.com/watch?v=abc123&feature=share') == canonical
+    assert normalize_url('https://youtube.com/shorts/abc123') == canonical
+    assert normalize_url('https://www.youtube.com/watch?t=42&v=abc123') == canonical
+
+
+def test_twitter_hosts_match():
+    canonical = normalize_url('https://twitter.com/user/status/1')
+    assert normalize_url('https://x.com/user/status/1?s=20&t=abc') == canonical
+    assert normalize_url('https://mobile.twitter.com/user/status/1/') == canonical
+
+
+def test_generic_tracking_params_dropped():
+    assert (normalize_url('https://example.com/v.mp4?utm_source=x&fbclid=y')
+            == normalize_url('https://example.com/v.mp4'))
+
+
+def test_port_is_kept():
+    assert (normalize_url('http://host:8000/a.mp4')
+            != normalize_url('http://host:9000/a.mp4'))
+    assert normalize_url('http://host:80/a.mp4') == normalize_url('http://host/a.mp4')
+
+
+def test_scheme_is_kept_for_other_sites():
+    assert (normalize_url('http://example.com/a.mp4')
+            != normalize_url('https://example.com/a.mp4'))
+
+
+def test_site_params_kept_on_other_hosts():
+    assert (normalize_url('https://example.com/video?t=abc123')
+            != normalize_url('https://example.com/video'))
+    assert (normalize_url('https://example.com/video?si=1')
+            != normalize_url('https://example.com/video'))
+
+
+def test_cache_key_depends_on_target():
+    url = 'https://example.com/a.mp4'
+    assert cache_key(url, 10) == cache_key(url + '?utm_medium=x', 10)
+    assert cache_key(url, 10) != cache_key(url, 20)
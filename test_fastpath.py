@@ -0,0 +1,122 @@
+import struct
+
+from fastpath import (
+    choose_strategy, is_stream_copyable, select_format, _moov_first,
+    AUDIO, COPY, REMUX, TRANSCODE,
+)
+
+MB = 1024 * 1024
+
+
+def box(kind, body=b''):
+    return struct.pack('>I4s', 8 + len(body), kind) + body
+
+
+def write_mp4(path, moov_first=True):
+    ftyp = box(b'ftyp', b'isom')
+    moov = box(b'moov', b'\0' * 16)
+    # 64-bit sized mdat, which _moov_first has to step over
+    mdat = struct.pack('>I4sQ', 1, b'mdat', 16 + 64) + b'\0' * 64
+    with open(path, 'wb') as f:
+        f.write(ftyp + (moov + mdat if moov_first else mdat + moov))
+    return str(path)
+
+
+def probe(path='', size=MB, brand='isom', pix_fmt='yuv420p', vcodec='h264',
+          acodec='aac', video_bit_rate=None, format_name='mov,mp4,m4a,3gp,3g2,mj2'):
+    video = {'codec_type': 'video', 'codec_name': vcodec, 'pix_fmt': pix_fmt}
+    if video_bit_rate:
+        video['bit_rate'] = str(video_bit_rate)
+    return {
+        'format': {'duration': '60', 'size': str(size), 'format_name': format_name,
+                   'filename': path, 'tags': {'major_brand': brand}},
+        'streams': [video, {'codec_type': 'audio', 'codec_name': acodec}],
+    }
+
+
+def test_moov_first(tmp_path):
+    assert _moov_first(write_mp4(tmp_path / 'fast.mp4'))
+    assert not _moov_first(write_mp4(tmp_path / 'slow.mp4', moov_first=False))
+    assert not _moov_first(str(tmp_path / 'missing.mp4'))
+
+
+def test_faststart_mp4_is_copied(tmp_path):
+    assert choose_strategy(probe(write_mp4(tmp_path / 'a.mp4')), 10 * MB) == COPY
+
+
+def test_index_at_end_is_remuxed(tmp_path):
+    path = write_mp4(tmp_path / 'a.mp4', moov_first=False)
+    assert choose_strategy(probe(path), 10 * MB) == REMUX
+
+
+def test_mov_and_3gp_are_remuxed(tmp_path):
+    path = write_mp4(tmp_path / 'a.mp4')
+    assert choose_strategy(probe(path, brand='qt  '), 10 * MB) == REMUX
+    assert choose_strategy(probe(path, brand='3gp4'), 10 * MB) == REMUX
+
+
+def test_other_containers_are_remuxed(tmp_path):
+    assert choose_strategy(probe(format_name='matroska,webm'), 10 * MB) == REMUX
+
+
+def test_high_bit_depth_is_transcoded(tmp_path):
+    path = write_mp4(tmp_path / 'a.mp4')
+    assert choose_strategy(probe(path, pix_fmt='yuv420p10le'), 10 * MB) == TRANSCODE
+    assert choose_strategy(probe(path, pix_fmt='yuv422p'), 10 * MB) == TRANSCODE
+
+
+def test_other_video_codecs_are_transcoded():
+    assert choose_strategy(probe(vcodec='hevc'), 10 * MB) == TRANSCODE
+
+
+def test_low_bitrate_video_keeps_its_stream():
+    # Too big overall, but the video alone fits the budget
+    source = probe(size=20 * MB, acodec='opus', video_bit_rate=500_000)
+    assert choose_strategy(source, 10 * MB) == AUDIO
+
+
+def test_high_bitrate_video_is_transcoded():
+    source = probe(size=50 * MB, video_bit_rate=6_000_000)
+    assert choose_strategy(source, 10 * MB) == TRANSCODE
+
+
+def test_stream_copy_needs_8bit_profile():
+    fmt = {'filesize': MB, 'acodec': 'mp4a.40.2'}
+    assert is_stream_copyable(dict(fmt, vcodec='avc1.64001F'), 60, 10 * MB)
+    assert not is_stream_copyable(dict(fmt, vcodec='avc1.6E001F'), 60, 10 * MB)
+    assert not is_stream_copyable(dict(fmt, vcodec='avc1.64001F', filesize=20 * MB),
+                                  60, 10 * MB)
+
+
+def fmt(format_id, height, filesize):
+    return {'format_id': format_id, 'ext': 'mp4', 'vcodec': 'avc1', 'acodec': 'mp4a',
+            'width': height * 16 // 9, 'height': height, 'filesize': filesize}
+
+
+def test_select_format_prefers_best_that_fits():
+    info = {'duration': 60, 'formats': [
+        fmt('360', 360, 3 * MB), fmt('720', 720, 8 * MB), fmt('1080', 1080, 30 * MB),
+    ]}
+    assert select_format(info, 10 * MB) == '720'
+
+
+def test_select_format_smallest_with_enough_pixels():
+    # 10 minutes at 10MB ends up encoded well below 720p
+    info = {'duration': 600, 'formats': [
+        fmt('240', 240, 15 * MB), fmt('480', 480, 40 * MB), fmt('1080', 1080, 200 * MB),
+    ]}
+    assert select_format(info, 10 * MB) == '240'
+
+
+def test_select_format_skips_formats_below_the_output_size():
+    # About 1.2Mbit/s of video: the encoder will output 720p, so 480p is too
+    # small a source and 1080p more than needed
+    info = {'duration': 60, 'formats': [
+        fmt('480', 480, 20 * MB), fmt('720', 720, 25 * MB), fmt('1080', 1080, 40 * MB),
+    ]}
+    assert select_format(info, 10 * MB) == '720'
+
+
+def test_select_format_without_sizes_keeps_default():
+    info = {'duration': 60, 'formats': [dict(fmt('720', 720, None))]}
+    assert select_format(info, 10 * MB) is None
@@ -0,0 +1,69 @@
+import pytest
+
+from ratecontrol import (
+    bitrate_budget, plan_encode, planned_short_side, _pick_geometry,
+    AUDIO_BITRATE_K, MIN_AUDIO_BITRATE_K, OVERHEAD_BYTES,
+)
+
+MB = 1024 * 1024
+
+
+def probe(duration, width=1920, height=1080, fps='30/1', audio=True):
+    streams = [{'codec_type': 'video', 'width': width, 'height': height,
+                'avg_frame_rate': fps}]
+    if audio:
+        streams.append({'codec_type': 'audio'})
+    return {'format': {'duration': str(duration)}, 'streams': streams}
+
+
+def test_budget_stays_under_target():
+    for duration in (5, 60, 600):
+        video_k, audio_k = bitrate_budget(duration, True, 10 * MB)
+        planned = (video_k + audio_k) * 1000 / 8 * duration + OVERHEAD_BYTES
+        assert planned < 10 * MB
+
+
+def test_audio_share_is_capped_and_floored():
+    assert bitrate_budget(10, True, 10 * MB)[1] == AUDIO_BITRATE_K
+    assert bitrate_budget(1800, True, 10 * MB)[1] == MIN_AUDIO_BITRATE_K
+    assert bitrate_budget(60, False, 10 * MB)[1] == 0
+
+
+def test_geometry_kept_when_bitrate_is_enough():
+    assert _pick_geometry(5_000_000, 1280, 720, 30) == (None, None)
+
+
+def test_geometry_steps_down_resolution():
+    # 0.043 bits/pixel at 720p30, too few at 1080p
+    assert _pick_geometry(1_200_000, 1920, 1080, 30) == (720, 30)
+
+
+def test_geometry_caps_framerate_when_stepping_down():
+    side, fps = _pick_geometry(1_200_000, 1920, 1080, 60)
+    assert fps == 30 and side == 720
+
+
+def test_geometry_falls_back_to_smallest_rung_at_film_rate():
+    assert _pick_geometry(50_000, 1920, 1080, 60) == (240, 24)
+
+
+def test_plan_scales_landscape_and_portrait():
+    assert plan_encode(probe(60), 10 * MB)['scale'] == 'scale=-2:720'
+    portrait = plan_encode(probe(60, width=1080, height=1920), 10 * MB)
+    assert portrait['scale'] == 'scale=720:-2'
+
+
+def test_plan_leaves_small_sources_alone():
+    plan = plan_encode(probe(30, width=640, height=360), 10 * MB)
+    assert plan['scale'] is None and plan['fps'] is None
+    assert plan['maxrate_k'] > plan['video_bitrate_k']
+
+
+def test_plan_refuses_sources_too_long_to_fit():
+    with pytest.raises(ValueError):
+        plan_encode(probe(4 * 3600), 10 * MB)
+
+
+def test_planned_short_side_matches_plan():
+    assert planned_short_side(60, 1920, 1080, 30, 10 * MB) == 720
+    assert planned_short_side(30, 640, 360, 30, 10 * MB) == 360